@@ -0,0 +1,107 @@
+#!/usr/bin/env python
+
+"""
+Compare pushback_itr against PushbackIterator on a tokenizer-style workload:
+scan characters, read ahead through runs of digits and push back the first
+character that isn't one.
+"""
+
+import os
+import sys
+import timeit
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+
+from util import algorithms
+
+
+TEXT = "x = 12 + foo(345, 6789) * bar[10] - 2\n" * 2000
+
+
+def scan_pushback_itr(text):
+	return sum(1 for c in algorithms.pushback_itr(text))
+
+
+def scan_pushback_iterator(text):
+	return sum(1 for c in algorithms.PushbackIterator(text))
+
+
+def tokenize_pushback_itr(text):
+	itr = algorithms.pushback_itr(text)
+	for c in itr:
+		if c.isdigit():
+			digits = [c]
+			for c in itr:
+				if c.isdigit():
+					digits.append(c)
+				else:
+					itr.send(c)
+					break
+			yield "".join(digits)
+		elif not c.isspace():
+			yield c
+
+
+def tokenize_pushback_iterator(text):
+	itr = algorithms.PushbackIterator(text)
+	for c in itr:
+		if c.isdigit():
+			digits = [c]
+			for c in itr:
+				if c.isdigit():
+					digits.append(c)
+				else:
+					itr.push(c)
+					break
+			yield "".join(digits)
+		elif not c.isspace():
+			yield c
+
+
+def tokenize_peek(text):
+	itr = algorithms.PushbackIterator(text)
+	for c in itr:
+		if c.isdigit():
+			digits = [c]
+			try:
+				while itr.peek().isdigit():
+					digits.append(itr.next())
+			except StopIteration:
+				pass
+			yield "".join(digits)
+		elif not c.isspace():
+			yield c
+
+
+def _time(func):
+	return min(timeit.repeat(lambda: func(TEXT), number=5, repeat=5)) / 5
+
+
+def main():
+	expected = list(tokenize_pushback_itr(TEXT))
+	workloads = [
+		("scan", [
+			("pushback_itr", scan_pushback_itr),
+			("PushbackIterator", scan_pushback_iterator),
+		]),
+		("tokenize", [
+			("pushback_itr + send", lambda text: list(tokenize_pushback_itr(text))),
+			("PushbackIterator + push", lambda text: list(tokenize_pushback_iterator(text))),
+			("PushbackIterator + peek", lambda text: list(tokenize_peek(text))),
+		]),
+	]
+	assert list(tokenize_pushback_iterator(TEXT)) == expected
+	assert list(tokenize_peek(TEXT)) == expected
+
+	print "%-10s %-26s %10s %9s" % ("workload", "implementation", "ns/char", "speedup")
+	for workload, implementations in workloads:
+		baseline = None
+		for name, func in implementations:
+			nsPerChar = _time(func) / len(TEXT) * 1e9
+			if baseline is None:
+				baseline = nsPerChar
+			print "%-10s %-26s %10.1f %8.2fx" % (workload, name, nsPerChar, baseline / nsPerChar)
+
+
+if __name__ == "__main__":
+	main()
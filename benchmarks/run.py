@@ -0,0 +1,283 @@
+#!/usr/bin/env python
+
+"""
+Throughput benchmarks for util.algorithms
+
+Each case is timed with timeit (best of several repeats) and reported as
+seconds per run.  Results can be written as JSON and compared against a
+baseline, failing when a case got slower than the tolerance allows.
+Baselines are machine specific, so regenerate baseline.json with
+--update-baseline when moving to new hardware.
+
+Usage:
+	python benchmarks/run.py
+	python benchmarks/run.py --output results.json --tolerance 0.25
+	python benchmarks/run.py --filter bloom --update-baseline
+"""
+
+from __future__ import with_statement
+
+import os
+import sys
+import json
+import datetime
+import itertools
+import optparse
+import platform
+import timeit
+
+_BENCHMARK_DIR = os.path.dirname(os.path.abspath(__file__))
+sys.path.insert(0, os.path.join(_BENCHMARK_DIR, ".."))
+
+from util import algorithms
+
+
+DEFAULT_BASELINE = os.path.join(_BENCHMARK_DIR, "baseline.json")
+
+
+def _keys(count, prefix = "key"):
+	return ["%s%d" % (prefix, i) for i in xrange(count)]
+
+
+def bloom_add(numBits):
+	keys = _keys(1000)
+
+	def run():
+		bf = algorithms.BloomFilter(numBits, 7)
+		for key in keys:
+			bf.add(key)
+	return run
+
+
+def bloom_contains(numBits):
+	bf = algorithms.BloomFilter(numBits, 7)
+	bf.add_many(_keys(1000))
+	keys = _keys(500) + _keys(500, "missing")
+
+	def run():
+		for key in keys:
+			key in bf
+	return run
+
+
+def bloom_add_many(numBits):
+	keys = _keys(10000)
+
+	def run():
+		algorithms.BloomFilter(numBits, 7).add_many(keys)
+	return run
+
+
+def bloom_contains_many(numBits):
+	bf = algorithms.BloomFilter(numBits, 7)
+	bf.add_many(_keys(5000))
+	keys = _keys(5000) + _keys(5000, "missing")
+
+	def run():
+		bf.contains_many(keys)
+	return run
+
+
+def lazylist_index():
+	def run():
+		ll = algorithms.LazyList(xrange(10000))
+		for i in xrange(10000):
+			ll[i]
+	return run
+
+
+def lazylist_recursive():
+	@algorithms.lazylist
+	def fibgen(lst):
+		yield 0
+		yield 1
+		for a, b in itertools.izip(lst, lst[1:]):
+			yield a + b
+
+	def run():
+		fibgen()[2000]
+	return run
+
+
+def product_iterate():
+	def run():
+		for v in algorithms.product(range(10), repeat=4):
+			pass
+	return run
+
+
+def product_unrank():
+	space = algorithms.product(range(10), repeat=8)
+
+	def run():
+		for i in xrange(0, 100000000, 100000):
+			space[i]
+	return run
+
+
+def itergroup():
+	values = range(100000)
+
+	def run():
+		for group in algorithms.itergroup(values, 4):
+			pass
+	return run
+
+
+def xmap():
+	values = range(10000)
+
+	def run():
+		for v in algorithms.xmap(abs, values):
+			pass
+	return run
+
+
+def pushback_itr():
+	values = range(10000)
+
+	def run():
+		itr = algorithms.pushback_itr(values)
+		for i in itr:
+			if i % 10 == 0:
+				itr.send(-1)
+	return run
+
+
+def daterange_iterate():
+	begin = datetime.datetime(2000, 1, 1)
+	end = datetime.datetime(2000, 1, 8)
+	minute = datetime.timedelta(minutes=1)
+
+	def run():
+		for d in algorithms.daterange(begin, end, minute):
+			pass
+	return run
+
+
+def daterange_index():
+	minutes = algorithms.daterange(
+		datetime.datetime(2000, 1, 1), datetime.datetime(2010, 1, 1), datetime.timedelta(minutes=1)
+	)
+
+	def run():
+		len(minutes)
+		for i in xrange(0, len(minutes), 1000):
+			minutes[i]
+	return run
+
+
+BENCHMARKS = [
+	("bloom_add_1e4", lambda: bloom_add(10 ** 4)),
+	("bloom_add_1e6", lambda: bloom_add(10 ** 6)),
+	("bloom_add_1e7", lambda: bloom_add(10 ** 7)),
+	("bloom_contains_1e4", lambda: bloom_contains(10 ** 4)),
+	("bloom_contains_1e6", lambda: bloom_contains(10 ** 6)),
+	("bloom_contains_1e7", lambda: bloom_contains(10 ** 7)),
+	("bloom_add_many_1e6", lambda: bloom_add_many(10 ** 6)),
+	("bloom_contains_many_1e6", lambda: bloom_contains_many(10 ** 6)),
+	("lazylist_index", lazylist_index),
+	("lazylist_recursive", lazylist_recursive),
+	("product_iterate", product_iterate),
+	("product_unrank", product_unrank),
+	("itergroup", itergroup),
+	("xmap", xmap),
+	("pushback_itr", pushback_itr),
+	("daterange_iterate", daterange_iterate),
+	("daterange_index", daterange_index),
+]
+
+
+def _calibrate(timer, minimumSeconds = 0.1):
+	"""Smallest power of two run count taking at least minimumSeconds"""
+	number = 1
+	while timer.timeit(number) < minimumSeconds:
+		number *= 2
+	return number
+
+
+def run_benchmarks(pattern = None, repeat = 5):
+	results = {}
+	for name, factory in BENCHMARKS:
+		if pattern is not None and pattern not in name:
+			continue
+		timer = timeit.Timer(factory())
+		number = _calibrate(timer)
+		results[name] = min(timer.repeat(repeat=repeat, number=number)) / number
+	return results
+
+
+def compare(results, baseline, tolerance):
+	"""
+	Return (name, baseline, result, ratio) for every case slower than
+	baseline * (1 + tolerance)
+	"""
+	regressions = []
+	for name, seconds in sorted(results.iteritems()):
+		expected = baseline.get(name)
+		if expected is None:
+			continue
+		ratio = seconds / expected
+		if 1 + tolerance < ratio:
+			regressions.append((name, expected, seconds, ratio))
+	return regressions
+
+
+def _load(path):
+	with open(path, "rb") as f:
+		return json.load(f)["results"]
+
+
+def _dump(path, results):
+	document = {
+		"python": platform.python_version(),
+		"machine": platform.machine(),
+		"results": results,
+	}
+	with open(path, "wb") as f:
+		json.dump(document, f, indent=1, separators=(",", ": "), sort_keys=True)
+		f.write("\n")
+
+
+def main(args):
+	parser = optparse.OptionParser()
+	parser.add_option("-o", "--output", help="write results as JSON to this file")
+	parser.add_option("-b", "--baseline", default=DEFAULT_BASELINE, help="baseline JSON to compare against")
+	parser.add_option("-t", "--tolerance", type="float", default=0.2, help="allowed slowdown, as a fraction of the baseline")
+	parser.add_option("-f", "--filter", help="only run benchmarks whose name contains this")
+	parser.add_option("-r", "--repeat", type="int", default=5, help="timeit repeats, the best is kept")
+	parser.add_option("-u", "--update-baseline", action="store_true", help="store the results as the new baseline")
+	options, positional = parser.parse_args(args)
+
+	results = run_benchmarks(options.filter, options.repeat)
+	if options.output:
+		_dump(options.output, results)
+
+	if options.update_baseline:
+		baseline = _load(options.baseline) if os.path.exists(options.baseline) else {}
+		baseline.update(results)
+		_dump(options.baseline, baseline)
+		baseline = results
+	elif os.path.exists(options.baseline):
+		baseline = _load(options.baseline)
+	else:
+		baseline = {}
+
+	print "%-26s %12s %12s %8s" % ("benchmark", "baseline ms", "result ms", "ratio")
+	for name, seconds in sorted(results.iteritems()):
+		expected = baseline.get(name)
+		if expected is None:
+			print "%-26s %12s %12.3f %8s" % (name, "-", seconds * 1e3, "-")
+		else:
+			print "%-26s %12.3f %12.3f %7.2fx" % (name, expected * 1e3, seconds * 1e3, seconds / expected)
+
+	regressions = compare(results, baseline, options.tolerance)
+	for name, expected, seconds, ratio in regressions:
+		print "REGRESSION %s: %.3f ms -> %.3f ms (%.2fx, tolerance %.0f%%)" % (
+			name, expected * 1e3, seconds * 1e3, ratio, options.tolerance * 100
+		)
+	return 1 if regressions else 0
+
+
+if __name__ == "__main__":
+	sys.exit(main(sys.argv[1:]))
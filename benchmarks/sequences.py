@@ -0,0 +1,108 @@
+#!/usr/bin/env python
+
+"""
+Time iterfirst, iterstep, iterwhile and itergroup against their original
+pure generator implementations across input types, printing a markdown table
+
+Results are kept in sequences.markdown
+"""
+
+import os
+import sys
+import mmap
+import array
+import tempfile
+import itertools
+import timeit
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+
+from util import algorithms
+
+
+SIZE = 100000
+REPEAT = 7
+NUMBER = 3
+
+
+def original_iterwhile(func, iterator):
+	iterator = iter(iterator)
+	while 1:
+		next = iterator.next()
+		if not func(next):
+			raise StopIteration
+		yield next
+
+
+def original_iterfirst(iterator, count=1):
+	iterator = iter(iterator)
+	for i in xrange(count):
+		yield iterator.next()
+
+
+def original_iterstep(iterator, n):
+	iterator = iter(iterator)
+	while True:
+		yield iterator.next()
+		for dummy in xrange(n-1):
+			iterator.next()
+
+
+def original_itergroup(iterator, count, padValue = None):
+	paddedIterator = itertools.chain(iterator, itertools.repeat(padValue, count-1))
+	nIterators = (paddedIterator, ) * count
+	return itertools.izip(*nIterators)
+
+
+def _always(value):
+	return True
+
+
+def _make_inputs():
+	f = tempfile.TemporaryFile()
+	f.write("x" * SIZE)
+	f.flush()
+	mapped = mmap.mmap(f.fileno(), SIZE, access=mmap.ACCESS_READ)
+	return [
+		("list", lambda: range(SIZE)),
+		("str", lambda: "x" * SIZE),
+		("array('d')", lambda: array.array('d', xrange(SIZE))),
+		("mmap", lambda: mapped),
+		("generator", lambda: (i for i in xrange(SIZE))),
+	]
+
+
+FUNCTIONS = [
+	("iterfirst(n/2)", original_iterfirst, algorithms.iterfirst, lambda func, seq: func(seq, SIZE // 2)),
+	("iterstep(4)", original_iterstep, algorithms.iterstep, lambda func, seq: func(seq, 4)),
+	("iterwhile", original_iterwhile, algorithms.iterwhile, lambda func, seq: func(_always, seq)),
+	("itergroup(4)", original_itergroup, algorithms.itergroup, lambda func, seq: func(seq, 4)),
+]
+
+
+def _time_call(func, apply, makeInput):
+	# Fresh inputs per call, as generators get consumed
+	seqs = [makeInput() for dummy in xrange(REPEAT * NUMBER)]
+
+	def run():
+		for v in apply(func, seqs.pop()):
+			pass
+	return min(timeit.repeat(run, repeat=REPEAT, number=NUMBER)) / NUMBER
+
+
+def main():
+	print "Python %s, %d values" % (sys.version.split()[0], SIZE)
+	print
+	print "| function | input | original (ms) | current (ms) | speedup |"
+	print "|---|---|---:|---:|---:|"
+	for name, original, current, apply in FUNCTIONS:
+		for inputName, makeInput in _make_inputs():
+			originalTime = _time_call(original, apply, makeInput)
+			currentTime = _time_call(current, apply, makeInput)
+			print "| %s | %s | %.2f | %.2f | %.1fx |" % (
+				name, inputName, originalTime * 1e3, currentTime * 1e3, originalTime / currentTime
+			)
+
+
+if __name__ == "__main__":
+	main()
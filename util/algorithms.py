@@ -4,31 +4,166 @@
 @note Source http://aspn.activestate.com/ASPN/Cookbook/Python/Recipe/66448
 """
 
+from __future__ import with_statement
+
+import sys
 import itertools
 import functools
 import datetime
+import calendar
 import types
+import heapq
+import operator
 import array
+import hashlib
 import random
+import struct
+import math
+import binascii
+import mmap as _mmap
+import multiprocessing
+import multiprocessing.pool
+import Queue
+import os
+import collections
+import tempfile
+import cPickle
+import threading
+import time
+
+try:
+	import numpy
+except ImportError:
+	numpy = None
+
+
+class _ReversedKey(object):
+
+	__slots__ = ["key"]
+
+	def __init__(self, key):
+		self.key = key
+
+	def __lt__(self, other):
+		return other.key < self.key
+
+	def __eq__(self, other):
+		return self.key == other.key
+
+
+def _spill_run(run):
+	f = tempfile.TemporaryFile()
+	dump = cPickle.Pickler(f, cPickle.HIGHEST_PROTOCOL).dump
+	for value in run:
+		dump(value)
+	f.seek(0)
+	return f
+
+
+def _load_run(f):
+	load = cPickle.Unpickler(f).load
+	try:
+		while True:
+			yield load()
+	except EOFError:
+		f.close()
+
+
+def _merge_runs(runs, key, reverse):
+	"""
+	Stable k-way merge of sorted runs
+
+	>>> list(_merge_runs([[1, 4, 7], [2, 5], [3, 6, 9]], None, False))
+	[1, 2, 3, 4, 5, 6, 7, 9]
+	>>> list(_merge_runs([["d", "b"], ["c", "a"]], str.upper, True))
+	['d', 'c', 'b', 'a']
+	"""
+	if key is None:
+		key = lambda value: value
+	wrap = _ReversedKey if reverse else (lambda k: k)
+
+	heap = []
+	for runIndex, run in enumerate(runs):
+		run = iter(run)
+		for value in run:
+			heap.append((wrap(key(value)), runIndex, value, run))
+			break
+	heapq.heapify(heap)
+
+	while heap:
+		sortKey, runIndex, value, run = heap[0]
+		yield value
+		for value in run:
+			heapq.heapreplace(heap, (wrap(key(value)), runIndex, value, run))
+			break
+		else:
+			heapq.heappop(heap)
 
 
-def ordered_itr(collection):
+def ordered_itr(collection, key = None, reverse = False, limit = None, run_size = None):
 	"""
+	Iterate over a collection in sorted order (dicts as sorted key/value pairs)
+
+	limit only yields the first limit values, tracked with a bounded heap
+	rather than a full sort.  run_size sorts the collection externally:
+	runs of that many values are sorted and spilled to temporary files then
+	lazily merged, bounding memory by run_size.
+
 	>>> [v for v in ordered_itr({"a": 1, "b": 2})]
 	[('a', 1), ('b', 2)]
 	>>> [v for v in ordered_itr([3, 1, 10, -20])]
 	[-20, 1, 3, 10]
+	>>> [v for v in ordered_itr([3, 1, 10, -20], key=abs, reverse=True)]
+	[-20, 10, 3, 1]
+	>>> [v for v in ordered_itr([3, 1, 10, -20], limit=2)]
+	[-20, 1]
+	>>> [v for v in ordered_itr({"a": 1, "b": 2, "c": 0}, reverse=True, limit=2)]
+	[('c', 0), ('b', 2)]
+	>>> values = [(i * 7919) % 1000 for i in xrange(1000)]
+	>>> list(ordered_itr(values, run_size=64)) == sorted(values)
+	True
+	>>> list(ordered_itr(values, key=lambda v: v % 10, reverse=True, run_size=64)) == sorted(values, key=lambda v: v % 10, reverse=True)
+	True
+	>>> list(ordered_itr([3, 1, 2], run_size=0))
+	Traceback (most recent call last):
+	ValueError: run_size must be at least 1, got 0
 	"""
 	if isinstance(collection, types.DictType):
-		keys = list(collection.iterkeys())
-		keys.sort()
-		for key in keys:
-			yield key, collection[key]
+		values = collection.iteritems()
+		valueKey = key if key is not None else (lambda k: k)
+		key = lambda item: valueKey(item[0])
 	else:
-		values = list(collection)
-		values.sort()
+		values = collection
+
+	if limit is not None:
+		select = heapq.nlargest if reverse else heapq.nsmallest
+		for value in select(limit, values, key=key):
+			yield value
+		return
+
+	if run_size is None:
+		values = sorted(values, key=key, reverse=reverse)
 		for value in values:
 			yield value
+		return
+
+	if run_size < 1:
+		raise ValueError("run_size must be at least 1, got %r" % (run_size, ))
+	values = iter(values)
+	runs = []
+	while True:
+		run = list(itertools.islice(values, run_size))
+		if not run:
+			break
+		run.sort(key=key, reverse=reverse)
+		if not runs and len(run) < run_size:
+			# Everything fit in memory after all
+			runs.append(run)
+			break
+		runs.append(_spill_run(run))
+	runs = [spilled if isinstance(spilled, list) else _load_run(spilled) for spilled in runs]
+	for value in _merge_runs(runs, key, reverse):
+		yield value
 
 
 def itercat(*iterators):
@@ -43,15 +178,191 @@ def itercat(*iterators):
 			yield x
 
 
+def _slice_indices(s, length):
+	"""
+	slice.indices for lengths beyond sys.maxsize, giving start, step and the
+	number of indices selected
+
+	>>> _slice_indices(slice(None, None, -2), 5)
+	(4, -2, 3)
+	>>> _slice_indices(slice(-3, None), 10 ** 20) == (10 ** 20 - 3, 1, 3)
+	True
+	"""
+	step = 1 if s.step is None else s.step
+	if step == 0:
+		raise ValueError("slice step cannot be zero")
+	if 0 < step:
+		lower, upper = 0, length
+	else:
+		lower, upper = -1, length - 1
+
+	if s.start is None:
+		start = lower if 0 < step else upper
+	elif s.start < 0:
+		start = max(s.start + length, lower)
+	else:
+		start = min(s.start, upper)
+	if s.stop is None:
+		stop = upper if 0 < step else lower
+	elif s.stop < 0:
+		stop = max(s.stop + length, lower)
+	else:
+		stop = min(s.stop, upper)
+
+	if 0 < step:
+		count = max(0, (stop - start + step - 1) // step)
+	else:
+		count = max(0, (start - stop - step - 1) // -step)
+	return start, step, count
+
+
+class Product(object):
+	"""
+	The cartesian product of several pools as a lazy sequence.  Tuples are
+	produced on demand, so the product can be iterated, measured, indexed
+	(unranked) and sliced without enumerating it.
+
+	>>> p = Product([tuple('ABCD'), tuple('xy')])
+	>>> len(p), p[0], p[3], p[-1]
+	(8, ('A', 'x'), ('B', 'y'), ('D', 'y'))
+	>>> ["".join(v) for v in p[2:7]]
+	['Bx', 'By', 'Cx', 'Cy', 'Dx']
+	>>> ["".join(v) for v in p[::3]]
+	['Ax', 'By', 'Dx']
+	>>> len(p[1::2]), p[1::2][-1]
+	(4, ('D', 'y'))
+	>>> ["".join(v) for v in p[::-3]]
+	['Dy', 'Cx', 'Ay']
+
+	len() is limited to sys.maxsize, the length property is not
+
+	>>> huge = Product([range(10)] * 20)
+	>>> huge.length
+	100000000000000000000L
+	>>> huge[-1] == (9, ) * 20, huge[10 ** 18:10 ** 18 + 2].length == 2
+	(True, True)
+	>>> list(huge[10 ** 19 - 1:10 ** 19 + 1])[1] == (1, ) + (0, ) * 19
+	True
+	>>> itertools.islice(huge, 1).next() == (0, ) * 20
+	True
+	"""
+
+	def __init__(self, pools, start = 0, step = 1, length = None):
+		self._pools = pools
+		self._sizes = [len(pool) for pool in pools]
+		self._size = 1
+		for size in self._sizes:
+			self._size *= size
+		if length is None:
+			length = self._size
+		self._start = start
+		self._step = step
+		self._length = length
+
+	def __len__(self):
+		return self._length
+
+	@property
+	def length(self):
+		return self._length
+
+	def __getitem__(self, i):
+		if isinstance(i, slice):
+			start, step, count = _slice_indices(i, self._length)
+			return Product(
+				self._pools,
+				self._start + start * self._step,
+				self._step * step,
+				count,
+			)
+
+		if i < 0:
+			i += self._length
+		if not 0 <= i < self._length:
+			raise IndexError("Product index out of range")
+		digits = self._unrank(self._start + i * self._step)
+		return tuple(pool[digit] for pool, digit in itertools.izip(self._pools, digits))
+
+	def __iter__(self):
+		if self._step != 1:
+			return self._stepped()
+		elif self._start == 0 and hasattr(itertools, "product"):
+			if self._length == self._size:
+				return itertools.product(*self._pools)
+			elif self._length <= sys.maxsize:
+				return itertools.islice(itertools.product(*self._pools), self._length)
+		return self._count_from(self._start, self._length)
+
+	def _stepped(self):
+		i = 0
+		while i < self._length:
+			yield self[i]
+			i += 1
+
+	def _unrank(self, index):
+		digits = []
+		for size in reversed(self._sizes):
+			index, digit = divmod(index, size)
+			digits.append(digit)
+		digits.reverse()
+		return digits
+
+	def _count_from(self, index, count):
+		# Odometer: bump the last digit, carrying leftwards
+		if not count:
+			return
+		pools = self._pools
+		sizes = self._sizes
+		digits = self._unrank(index)
+		current = [pool[digit] for pool, digit in itertools.izip(pools, digits)]
+		positions = range(len(pools) - 1, -1, -1)
+		yield tuple(current)
+		count -= 1
+		while count:
+			count -= 1
+			for pos in positions:
+				digit = digits[pos] + 1
+				if digit < sizes[pos]:
+					digits[pos] = digit
+					current[pos] = pools[pos][digit]
+					break
+				digits[pos] = 0
+				current[pos] = pools[pos][0]
+			yield tuple(current)
+
+
 def product(*args, **kwds):
-	# product('ABCD', 'xy') --> Ax Ay Bx By Cx Cy Dx Dy
-	# product(range(2), repeat=3) --> 000 001 010 011 100 101 110 111
+	"""
+	Lazy cartesian product, see Product.  This returns a Product sequence
+	rather than a generator, so call iter() on it to get an iterator.
+
+	>>> ["".join(v) for v in product('ABCD', 'xy')]
+	['Ax', 'Ay', 'Bx', 'By', 'Cx', 'Cy', 'Dx', 'Dy']
+	>>> ["".join(str(i) for i in v) for v in product(range(2), repeat=3)]
+	['000', '001', '010', '011', '100', '101', '110', '111']
+	>>> huge = product(range(10), repeat=8)
+	>>> len(huge), huge[12345678]
+	(100000000, (1, 2, 3, 4, 5, 6, 7, 8))
+	>>> list(huge[99999998:])
+	[(9, 9, 9, 9, 9, 9, 9, 8), (9, 9, 9, 9, 9, 9, 9, 9)]
+	>>> iter(product('ab')).next()
+	('a',)
+	>>> list(product())
+	[()]
+	"""
 	pools = map(tuple, args) * kwds.get('repeat', 1)
-	result = [[]]
-	for pool in pools:
-		result = [x+[y] for x in result for y in pool]
-	for prod in result:
-		yield tuple(prod)
+	return Product(pools)
+
+
+# Sequences whose slices have the same type and iterate the same way
+_SLICEABLE_TYPES = (list, tuple, str, unicode, array.array, bytearray)
+
+# Bytes-like objects a buffer() can window without copying
+_BUFFER_TYPES = (str, _mmap.mmap, buffer)
+
+# Most values the sequence fast paths copy out as a slice; beyond this they
+# iterate lazily rather than hold a second copy
+_SLICE_COPY_LIMIT = 4096
 
 
 def iterwhile(func, iterator):
@@ -61,43 +372,55 @@ def iterwhile(func, iterator):
 	>>> [v for v in iterwhile(through, [True, True, False])]
 	[True, True]
 	"""
-	iterator = iter(iterator)
-	while 1:
-		next = iterator.next()
-		if not func(next):
-			raise StopIteration
-		yield next
+	return itertools.takewhile(func, iterator)
 
 
 def iterfirst(iterator, count=1):
 	"""
 	Iterate through 'count' first values.
 
+	Bytes-like objects are windowed with buffer() rather than stepped
+	through, and sequences sliced when count is small.
+
 	>>> [v for v in iterfirst([1, 2, 3, 4, 5], 3)]
 	[1, 2, 3]
+	>>> [v for v in iterfirst(iter([1, 2, 3, 4, 5]), 3)]
+	[1, 2, 3]
+	>>> [v for v in iterfirst(buffer("abcdef"), 2)], [v for v in iterfirst("ab", 5)]
+	(['a', 'b'], ['a', 'b'])
+	>>> [v for v in iterfirst([1, 2], -1)]
+	[]
 	"""
-	iterator = iter(iterator)
-	for i in xrange(count):
-		yield iterator.next()
+	count = max(count, 0)
+	if isinstance(iterator, _BUFFER_TYPES):
+		return iter(buffer(iterator, 0, count))
+	elif isinstance(iterator, _SLICEABLE_TYPES) and count <= _SLICE_COPY_LIMIT:
+		return iter(iterator[:count])
+	return itertools.islice(iterator, count)
 
 
 def iterstep(iterator, n):
 	"""
 	Iterate every nth value.
 
+	Sequences use an extended slice instead of skipping values one by one
+	when that selects only a few values.
+
 	>>> [v for v in iterstep([1, 2, 3, 4, 5], 1)]
 	[1, 2, 3, 4, 5]
 	>>> [v for v in iterstep([1, 2, 3, 4, 5], 2)]
 	[1, 3, 5]
 	>>> [v for v in iterstep([1, 2, 3, 4, 5], 3)]
 	[1, 4]
+	>>> [v for v in iterstep(iter([1, 2, 3, 4, 5]), 3)]
+	[1, 4]
+	>>> "".join(iterstep("abcdef", 2))
+	'ace'
 	"""
-	iterator = iter(iterator)
-	while True:
-		yield iterator.next()
-		# skip n-1 values
-		for dummy in xrange(n-1):
-			iterator.next()
+	n = max(n, 1)
+	if isinstance(iterator, _SLICEABLE_TYPES) and len(iterator) // n <= _SLICE_COPY_LIMIT:
+		return iter(iterator[::n])
+	return itertools.islice(iterator, 0, None, n)
 
 
 def itergroup(iterator, count, padValue = None):
@@ -141,8 +464,13 @@ def xzip(*iterators):
 
 
 def xmap(func, *iterators):
-	"""Iterative version of builtin 'map'."""
-	iterators = itertools.imap(iter, iterators)
+	"""
+	Iterative version of builtin 'map'.
+
+	>>> list(xmap(lambda a, b: (a, b), [1, 2], [3]))
+	[(1, 3), (2, None)]
+	"""
+	iterators = map(iter, iterators)
 	values_left = [1]
 
 	def values():
@@ -168,6 +496,114 @@ def xmap(func, *iterators):
 		yield func(*args)
 
 
+# How long parallel_xmap waits on results before checking for pool errors
+_POOL_POLL_INTERVAL = 0.05
+
+
+def _indexed_call(func, index, item):
+	# Exceptions are returned rather than raised so the pool's result
+	# callback always fires
+	try:
+		return index, True, func(item)
+	except Exception, e:
+		return index, False, e
+
+
+def parallel_xmap(func, iterable, workers = None, mode = "thread", prefetch = None, ordered = True):
+	"""
+	Lazily map func over iterable with a pool of threads or processes,
+	keeping at most prefetch items submitted but not yet yielded.  The first
+	error raised by func is re-raised as soon as it arrives.
+
+	In "process" mode func and the items must be picklable.
+
+	>>> list(parallel_xmap(abs, xrange(-5, 5), workers=3, prefetch=4))
+	[5, 4, 3, 2, 1, 0, 1, 2, 3, 4]
+	>>> list(parallel_xmap(abs, xrange(-5, 5), workers=2, mode="process"))
+	[5, 4, 3, 2, 1, 0, 1, 2, 3, 4]
+	>>> sorted(parallel_xmap(abs, xrange(-5, 5), workers=3, ordered=False))
+	[0, 1, 1, 2, 2, 3, 3, 4, 4, 5]
+	>>> list(iterfirst(parallel_xmap(abs, itertools.count(-2), workers=2), 3))
+	[2, 1, 0]
+	>>> list(parallel_xmap(lambda x: 1 / x, [1, 0, 2], workers=2))
+	Traceback (most recent call last):
+	ZeroDivisionError: integer division or modulo by zero
+
+	Errors the pool hits itself, such as failing to pickle the function, are
+	raised too rather than waited on forever
+
+	>>> list(parallel_xmap(lambda x: x + 1, range(5), workers=2, mode="process")) # doctest: +ELLIPSIS
+	Traceback (most recent call last):
+	PicklingError: Can't pickle ...
+	"""
+	if workers is None:
+		workers = multiprocessing.cpu_count()
+	if prefetch is None:
+		prefetch = workers * 2
+	pool = _make_pool(workers, mode)
+	try:
+		for value in _pool_xmap(pool, func, iterable, prefetch, ordered):
+			yield value
+	finally:
+		pool.terminate()
+		pool.join()
+
+
+def _make_pool(workers, mode):
+	if mode == "thread":
+		return multiprocessing.pool.ThreadPool(workers)
+	elif mode == "process":
+		return multiprocessing.Pool(workers)
+	else:
+		raise ValueError("Unknown mode %r" % (mode, ))
+
+
+def _pool_xmap(pool, func, iterable, prefetch, ordered):
+	"""The body of parallel_xmap, over a pool the caller owns"""
+	completed = Queue.Queue()
+	items = iter(iterable)
+	isExhausted = False
+	submitted = 0
+	yielded = 0
+	pending = {}
+	# Results still in the pool.  Its own failures (pickling, mostly)
+	# never reach the callback so these are checked whenever it is quiet
+	outstanding = {}
+	while True:
+		while not isExhausted and submitted - yielded < prefetch:
+			try:
+				item = items.next()
+			except StopIteration:
+				isExhausted = True
+				break
+			outstanding[submitted] = pool.apply_async(
+				_indexed_call, (func, submitted, item), callback=completed.put
+			)
+			submitted += 1
+		if submitted == yielded:
+			break
+
+		try:
+			index, isSuccess, value = completed.get(timeout=_POOL_POLL_INTERVAL)
+		except Queue.Empty:
+			for result in outstanding.itervalues():
+				if result.ready() and not result.successful():
+					result.get()
+			continue
+		del outstanding[index]
+		if not isSuccess:
+			raise value
+		if ordered:
+			pending[index] = value
+			while yielded in pending:
+				readyValue = pending.pop(yielded)
+				yielded += 1
+				yield readyValue
+		else:
+			yielded += 1
+			yield value
+
+
 def xfilter(func, iterator):
 	"""Iterative version of builtin 'filter'."""
 	iterator = iter(iterator)
@@ -193,6 +629,309 @@ def xreduce(func, iterator, default=None):
 	return prev
 
 
+# Tells parallel_reduce's initializer apart from an initializer of None
+_NO_INITIALIZER = object()
+
+
+def parallel_reduce(func, iterable, chunk_size = 1024, workers = None, mode = "thread", initializer = _NO_INITIALIZER, default = None):
+	"""
+	Reduce with an associative func by reducing chunk_size chunks in a thread
+	or process pool (see parallel_xmap), then combining the partial results
+	pairwise in a balanced tree.
+
+	initializer, when given, is folded in ahead of the first value as with
+	the builtin reduce.  Inputs no bigger than a chunk are reduced serially
+	with xreduce semantics, including default.
+
+	>>> import operator
+	>>> parallel_reduce(operator.add, xrange(10000), chunk_size=100, workers=3)
+	49995000
+	>>> parallel_reduce(operator.add, xrange(10000), chunk_size=64, workers=2, mode="process", initializer=5)
+	49995005
+	>>> parallel_reduce(operator.add, [[1], [2], [3]], initializer=[0])
+	[0, 1, 2, 3]
+	>>> parallel_reduce(operator.or_, (set([i]) for i in xrange(100)), chunk_size=7) == set(xrange(100))
+	True
+	>>> parallel_reduce(operator.add, [], default=0), parallel_reduce(operator.add, [4], default=1)
+	(0, 5)
+	>>> parallel_reduce(operator.add, [], initializer=3)
+	3
+	>>> parallel_reduce(operator.add, [1], chunk_size=1, default=10)
+	11
+	>>> parallel_reduce(lambda a, b: [a, b], [1, 2], chunk_size=1, initializer=None)
+	[[None, 1], 2]
+	"""
+	items = iter(iterable)
+	# One past a chunk tells whether the input fits in a chunk
+	firstChunk = list(itertools.islice(items, chunk_size + 1))
+	if len(firstChunk) <= chunk_size:
+		if initializer is not _NO_INITIALIZER:
+			return reduce(func, firstChunk, initializer)
+		return xreduce(func, firstChunk, default)
+	items = itertools.chain(firstChunk[chunk_size:], items)
+	firstChunk = firstChunk[:chunk_size]
+
+	def chunks():
+		chunk = firstChunk
+		while chunk:
+			yield chunk
+			chunk = list(itertools.islice(items, chunk_size))
+
+	if workers is None:
+		workers = multiprocessing.cpu_count()
+	prefetch = workers * 2
+	reducer = functools.partial(reduce, func)
+	# One pool for the chunks and every level of the combining tree
+	pool = _make_pool(workers, mode)
+	try:
+		partials = list(_pool_xmap(pool, reducer, chunks(), prefetch, True))
+		if initializer is not _NO_INITIALIZER:
+			partials[0] = func(initializer, partials[0])
+
+		while 1 < len(partials):
+			pairs = [partials[i:i+2] for i in xrange(0, len(partials) - 1, 2)]
+			carried = partials[-1:] if len(partials) % 2 else []
+			partials = list(_pool_xmap(pool, reducer, pairs, prefetch, True)) + carried
+	finally:
+		pool.terminate()
+		pool.join()
+	return partials[0]
+
+
+def _open_unit(rng):
+	"""Uniform random number in (0, 1), safe to take the log of"""
+	u = rng.random()
+	while not u:
+		u = rng.random()
+	return u
+
+
+def reservoir_skips(k, rng = None):
+	"""
+	Algorithm L: yield how many items to skip before each reservoir
+	replacement when sampling k items, after the first k were taken.  For
+	samplers that are fed items rather than pulling them, like cosample.
+
+	>>> skips = reservoir_skips(10, random.Random(1))
+	>>> all(0 <= skips.next() for i in xrange(100))
+	True
+
+	Source: Li "Reservoir-Sampling Algorithms of Time Complexity
+	O(n(1 + log(N/n)))"
+	"""
+	if rng is None:
+		rng = random
+	w = math.exp(math.log(_open_unit(rng)) / k)
+	while True:
+		if w < 1.0:
+			yield int(math.floor(math.log(_open_unit(rng)) / math.log1p(-w)))
+		else:
+			yield 0
+		w *= math.exp(math.log(_open_unit(rng)) / k)
+
+
+def reservoir_sample(iterable, k, rng = None):
+	"""
+	Uniformly sample k items from an iterable of unknown length in one pass,
+	with O(k (1 + log(n / k))) random draws by skipping ahead (Algorithm L).
+	The order of the sample is arbitrary.
+
+	>>> rng = random.Random(1)
+	>>> sample = reservoir_sample(xrange(1000000), 5, rng)
+	>>> len(sample), len(set(sample)), all(0 <= i < 1000000 for i in sample)
+	(5, 5, True)
+	>>> sorted(reservoir_sample(xrange(3), 5))
+	[0, 1, 2]
+	>>> counts = [0] * 10
+	>>> for i in xrange(2000):
+	... 	for v in reservoir_sample(xrange(10), 2, rng):
+	... 		counts[v] += 1
+	>>> all(300 < c < 500 for c in counts)
+	True
+	"""
+	if rng is None:
+		rng = random
+	iterator = iter(iterable)
+	reservoir = list(itertools.islice(iterator, k))
+	if len(reservoir) < k or k <= 0:
+		return reservoir
+
+	for skip in reservoir_skips(k, rng):
+		try:
+			item = itertools.islice(iterator, skip, skip + 1).next()
+		except StopIteration:
+			break
+		reservoir[rng.randrange(k)] = item
+	return reservoir
+
+
+def _exponential_jump(minKey, rng):
+	"""Total weight to pass over before the next A-ExpJ replacement"""
+	if not 0.0 < minKey < 1.0:
+		# Keys rounded to the ends of the range; replace at the next item
+		return 0.0
+	return math.log(_open_unit(rng)) / math.log(minKey)
+
+
+def weighted_reservoir_sample(iterable, k, weight = None, rng = None):
+	"""
+	Sample k items without replacement, each with probability proportional
+	to its weight, in one pass using exponential jumps (A-ExpJ).  Without a
+	weight function the iterable yields (item, weight) pairs.  Items with no
+	weight are never picked.
+
+	Source: Efraimidis, Spirakis "Weighted random sampling with a reservoir"
+
+	>>> rng = random.Random(1)
+	>>> counts = {"heavy": 0, "light": 0}
+	>>> for i in xrange(1000):
+	... 	for v in weighted_reservoir_sample([("heavy", 9), ("light", 1)] * 5, 1, rng=rng):
+	... 		counts[v] += 1
+	>>> 850 < counts["heavy"] < 950
+	True
+	>>> len(set(weighted_reservoir_sample(xrange(5), 3, weight=lambda i: i + 1)))
+	3
+	>>> weighted_reservoir_sample([("only", 0)], 1)
+	[]
+	"""
+	if rng is None:
+		rng = random
+	if weight is None:
+		pairs = iter(iterable)
+	else:
+		pairs = ((item, weight(item)) for item in iterable)
+	if k <= 0:
+		return []
+
+	# Entries are (key, tiebreak, item); the smallest key is evicted first
+	heap = []
+	counter = itertools.count()
+	for item, itemWeight in pairs:
+		if 0 < itemWeight:
+			heap.append((_open_unit(rng) ** (1.0 / itemWeight), counter.next(), item))
+			if len(heap) == k:
+				break
+	if len(heap) < k:
+		return [entryItem for entryKey, entryTiebreak, entryItem in heap]
+	heapq.heapify(heap)
+
+	jump = _exponential_jump(heap[0][0], rng)
+	for item, itemWeight in pairs:
+		if itemWeight <= 0:
+			continue
+		jump -= itemWeight
+		if 0 < jump:
+			continue
+		threshold = heap[0][0] ** itemWeight
+		key = rng.uniform(threshold, 1.0) ** (1.0 / itemWeight)
+		heapq.heapreplace(heap, (key, counter.next(), item))
+		jump = _exponential_jump(heap[0][0], rng)
+	return [entryItem for entryKey, entryTiebreak, entryItem in heap]
+
+
+def _timedelta_microseconds(delta):
+	return (delta.days * 86400 + delta.seconds) * 1000000 + delta.microseconds
+
+
+def _epoch_seconds_array(begin, step, length):
+	"""
+	>>> _epoch_seconds_array(datetime.date(2011, 1, 1), 86400000000, 3)
+	array('d', [1293840000.0, 1293926400.0, 1294012800.0])
+	>>> _epoch_seconds_array(datetime.datetime(1970, 1, 1, 0, 0, 0, 500000), 250000, 3)
+	array('d', [0.5, 0.75, 1.0])
+	"""
+	start = calendar.timegm(begin.timetuple())
+	if isinstance(begin, datetime.datetime):
+		start += begin.microsecond / 1e6
+	step /= 1e6
+	return array.array('d', (start + i * step for i in xrange(length)))
+
+
+class DateRange(object):
+	"""
+	A lazy, xrange-like sequence of dates, computed arithmetically
+
+	>>> dr = DateRange(datetime.datetime(2011, 1, 1), datetime.timedelta(minutes=15), 3)
+	>>> list(dr)
+	[datetime.datetime(2011, 1, 1, 0, 0), datetime.datetime(2011, 1, 1, 0, 15), datetime.datetime(2011, 1, 1, 0, 30)]
+	>>> dr[-1], len(dr[1:]), dr[::2][1]
+	(datetime.datetime(2011, 1, 1, 0, 30), 2, datetime.datetime(2011, 1, 1, 0, 30))
+	>>> datetime.datetime(2011, 1, 1, 0, 15) in dr, datetime.datetime(2011, 1, 1, 0, 20) in dr
+	(True, False)
+	>>> datetime.date(2011, 1, 1) in dr
+	False
+	"""
+
+	def __init__(self, begin, delta, length):
+		self._begin = begin
+		self._delta = delta
+		self._length = length
+
+	def __len__(self):
+		return self._length
+
+	def __getitem__(self, i):
+		if isinstance(i, slice):
+			start, stop, step = i.indices(self._length)
+			return DateRange(
+				self._begin + self._delta * start,
+				self._delta * step,
+				len(xrange(start, stop, step)),
+			)
+
+		if i < 0:
+			i += self._length
+		if not 0 <= i < self._length:
+			raise IndexError("DateRange index out of range")
+		return self._begin + self._delta * i
+
+	def __iter__(self):
+		current = self._begin
+		delta = self._delta
+		for dummy in xrange(self._length):
+			yield current
+			current += delta
+
+	def __contains__(self, value):
+		if type(value) is not type(self._begin) or not self._length:
+			return False
+		try:
+			offset = _timedelta_microseconds(value - self._begin)
+		except TypeError:
+			# Mixing naive and aware datetimes
+			return False
+		step = _timedelta_microseconds(self._delta)
+		if not step:
+			return offset == 0
+		index, remainder = divmod(offset, step)
+		return remainder == 0 and 0 <= index < self._length
+
+	def as_array(self):
+		"""
+		All of the dates at once, as a NumPy datetime64 array or, without
+		NumPy, an array('d') of seconds since the epoch (UTC for aware dates)
+
+		>>> dr = daterange(datetime.date(2011, 1, 1), datetime.date(2011, 1, 4))
+		>>> len(dr.as_array())
+		3
+		"""
+		begin = self._begin
+		if isinstance(begin, datetime.datetime) and begin.utcoffset() is not None:
+			begin = begin.replace(tzinfo=None) - begin.utcoffset()
+		step = _timedelta_microseconds(self._delta)
+
+		if numpy is not None:
+			if isinstance(begin, datetime.datetime) or step % 86400000000:
+				start = numpy.datetime64(begin, "us")
+				steps = numpy.timedelta64(step, "us")
+			else:
+				start = numpy.datetime64(begin, "D")
+				steps = numpy.timedelta64(step // 86400000000, "D")
+			return start + numpy.arange(self._length) * steps
+		else:
+			return _epoch_seconds_array(begin, step, self._length)
+
+
 def daterange(begin, end, delta = datetime.timedelta(1)):
 	"""
 	Form a range of dates and iterate over them.
@@ -204,24 +943,78 @@ def daterange(begin, end, delta = datetime.timedelta(1)):
 			Default step is 1 day.
 
 	Usage:
+	>>> list(daterange(datetime.date(2011, 1, 1), datetime.date(2011, 1, 3)))
+	[datetime.date(2011, 1, 1), datetime.date(2011, 1, 2)]
+	>>> list(daterange(datetime.date(2011, 1, 3), datetime.date(2011, 1, 1), -1))
+	[datetime.date(2011, 1, 3), datetime.date(2011, 1, 2)]
+	>>> list(daterange(datetime.date(2011, 1, 1), datetime.date(2011, 1, 3), -1))
+	[]
+	>>> minutes = daterange(datetime.datetime(2000, 1, 1), datetime.datetime(2010, 1, 1), datetime.timedelta(minutes=1))
+	>>> len(minutes), minutes[-1]
+	(5260320, datetime.datetime(2009, 12, 31, 23, 59))
 	"""
 	if not isinstance(delta, datetime.timedelta):
 		delta = datetime.timedelta(delta)
 
-	ZERO = datetime.timedelta(0)
-
-	if begin < end:
-		if delta <= ZERO:
-			raise StopIteration
-		test = end.__gt__
+	span = _timedelta_microseconds(end - begin)
+	step = _timedelta_microseconds(delta)
+	if span == 0 or step == 0 or (span < 0) != (step < 0):
+		length = 0
 	else:
-		if delta >= ZERO:
-			raise StopIteration
-		test = end.__lt__
+		# Ceiling division, as the range stops short of end
+		length = -(-span // step)
+	return DateRange(begin, delta, length)
+
+
+class _NullLock(object):
+
+	def __enter__(self):
+		return self
 
-	while test(begin):
-		yield begin
-		begin += delta
+	def __exit__(self, *args):
+		return False
+
+
+class _ArrayView(object):
+	"""
+	Read-only, zero-copy view of part of an array.array that stays valid as
+	the array grows, since it indexes the array rather than its memory
+
+	>>> view = _ArrayView(array.array('i', range(10)), 1, 9, 3)
+	>>> len(view), view[0], view[-1], list(view), list(view[1:])
+	(3, 1, 7, [1, 4, 7], [4, 7])
+	"""
+
+	def __init__(self, arr, start, stop, step):
+		self._arr = arr
+		self._start = start
+		self._step = step
+		self._length = len(xrange(start, stop, step))
+
+	def __len__(self):
+		return self._length
+
+	def __getitem__(self, i):
+		if isinstance(i, slice):
+			start, stop, step = i.indices(self._length)
+			return _ArrayView(
+				self._arr,
+				self._start + start * self._step,
+				self._start + stop * self._step,
+				self._step * step,
+			)
+		if i < 0:
+			i += self._length
+		if not 0 <= i < self._length:
+			raise IndexError("view index out of range")
+		return self._arr[self._start + i * self._step]
+
+	def __iter__(self):
+		if self._step < 0:
+			return (self[i] for i in xrange(self._length))
+		return itertools.islice(
+			self._arr, self._start, self._start + self._length * self._step, self._step
+		)
 
 
 class LazyList(object):
@@ -233,15 +1026,51 @@ class LazyList(object):
 	of values generated lazily. One can also create recursively defined lazy lists
 	that generate their values based on ones previously generated.
 
+	chunk_size pulls at least that many values from the iterator each time
+	more are needed.  threadsafe serializes pulling values so several threads
+	can index the same list.
+
 	Backport to python 2.5 by Michael Pust
+
+	>>> ll = LazyList(xrange(10), chunk_size=4)
+	>>> ll[1], len(ll)
+	(1, 4)
+	>>> ll[-1], len(ll)
+	(9, 10)
+	>>> ll = LazyList(xrange(10000), threadsafe=True)
+	>>> threads = [threading.Thread(target=ll.__getitem__, args=(i, )) for i in xrange(100, 10000, 100)]
+	>>> for t in threads:
+	... 	t.start()
+	>>> for t in threads:
+	... 	t.join()
+	>>> list(ll) == range(10000)
+	True
+
+	typecode stores values compactly in an array.array of that type, with
+	bounded slices and computed() returning views onto it rather than copies
+
+	>>> prices = LazyList((i * 0.5 for i in itertools.count()), typecode='d')
+	>>> prices[3], prices._data.itemsize
+	(1.5, 8)
+	>>> window = prices[2:10:2]
+	>>> len(window), window[-1], list(window)
+	(4, 4.0, [1.0, 2.0, 3.0, 4.0])
+	>>> list(window[1:3])
+	[2.0, 3.0]
+	>>> len(prices.computed())
+	10
 	"""
 
 	__author__ = 'Dan Spitz'
 
-	def __init__(self, iterable):
+	def __init__(self, iterable, chunk_size = 1, threadsafe = False, typecode = None):
 		self._exhausted = False
 		self._iterator = iter(iterable)
-		self._data = []
+		self._typecode = typecode
+		self._data = [] if typecode is None else array.array(typecode)
+		self._chunk_size = chunk_size
+		# Reentrant as recursive lazy lists index themselves while producing
+		self._lock = threading.RLock() if threadsafe else _NullLock()
 
 	def __len__(self):
 		"""Get the length of a LazyList's computed data."""
@@ -249,14 +1078,15 @@ class LazyList(object):
 
 	def __getitem__(self, i):
 		"""Get an item from a LazyList.
-		i should be a positive integer or a slice object."""
+		i should be an integer or a slice object.  Negative integers exhaust
+		the list to find its end."""
 		if isinstance(i, int):
 			#index has not yet been yielded by iterator (or iterator exhausted
 			#before reaching that index)
 			if i >= len(self):
 				self.exhaust(i)
 			elif i < 0:
-				raise ValueError('cannot index LazyList with negative number')
+				self.exhaust()
 			return self._data[i]
 
 		#LazyList slices are iterators over a portion of the list.
@@ -271,6 +1101,12 @@ class LazyList(object):
 			if step is None:
 				step = 1
 
+			#bounded slices of typed lists are views onto the computed array
+			if self._typecode is not None and stop is not None:
+				if 0 < stop:
+					self.exhaust(stop - 1)
+				return _ArrayView(self._data, start, min(stop, len(self._data)), step)
+
 			def LazyListIterator():
 				count = start
 				predicate = (
@@ -297,7 +1133,7 @@ class LazyList(object):
 
 	def computed(self):
 		"""Return an iterator over the values in a LazyList that have
-		already been computed."""
+		already been computed (a view for typed LazyLists)."""
 		return self[:len(self)]
 
 	def exhaust(self, index = None):
@@ -308,17 +1144,119 @@ class LazyList(object):
 		"""
 		if self._exhausted:
 			return
-		if index is None:
-			ind_range = itertools.count(len(self))
-		else:
-			ind_range = range(len(self), index + 1)
+		with self._lock:
+			#another thread may have pulled the values while we waited
+			if self._exhausted or (index is not None and index < len(self)):
+				return
+			if index is None:
+				self._extend(self._iterator)
+				self._exhausted = True
+				return
 
-		for ind in ind_range:
-			try:
-				self._data.append(self._iterator.next())
-			except StopIteration: #iterator is fully exhausted
+			count = max(index + 1 - len(self), self._chunk_size)
+			expectedLength = len(self) + count
+			self._extend(itertools.islice(self._iterator, count))
+			if len(self) < expectedLength: #iterator is fully exhausted
 				self._exhausted = True
-				break
+
+	def _extend(self, values):
+		#extend appends as it goes, so recursive lazy lists see each value
+		self._data.extend(values)
+
+
+class EvictedError(LookupError):
+	"""An index a WindowedLazyList no longer holds"""
+
+
+class WindowedLazyList(LazyList):
+	"""
+	A LazyList that only holds on to the last window values it computed.
+	Older values are dropped, raising EvictedError when indexed, unless spill
+	is set, in which case they are pickled to a temporary file and read back
+	on demand.
+
+	>>> wll = WindowedLazyList(xrange(100), 10)
+	>>> wll[50], len(wll)
+	(50, 51)
+	>>> wll[41], wll[-1]
+	(41, 99)
+	>>> list(wll.computed()) == range(90, 100)
+	True
+	>>> wll[40]
+	Traceback (most recent call last):
+	EvictedError: index 40 was evicted, only 90 to 99 are held
+	>>> spilled = WindowedLazyList(xrange(100), 10, spill=True)
+	>>> spilled[99], spilled[40], list(spilled[:5])
+	(99, 40, [0, 1, 2, 3, 4])
+
+	chunk_size is capped at window, so a refill never evicts what it was
+	pulled in for
+
+	>>> WindowedLazyList(xrange(100), 3, chunk_size=10)[0]
+	0
+	>>> WindowedLazyList(xrange(100), 0)
+	Traceback (most recent call last):
+	ValueError: window must be at least 1, got 0
+	"""
+
+	def __init__(self, iterable, window, spill = False, chunk_size = 1, threadsafe = False):
+		if window < 1:
+			raise ValueError("window must be at least 1, got %r" % (window, ))
+		super(WindowedLazyList, self).__init__(iterable, min(chunk_size, window), threadsafe)
+		self._data = collections.deque(maxlen=window)
+		self._evicted = 0
+		if spill:
+			self._spill = tempfile.TemporaryFile()
+			self._spillOffsets = array.array('L')
+		else:
+			self._spill = None
+
+	def __len__(self):
+		"""Get the number of values computed so far, held or not."""
+		return self._evicted + len(self._data)
+
+	def __getitem__(self, i):
+		if isinstance(i, int):
+			if i >= len(self):
+				self.exhaust(i)
+			elif i < 0:
+				self.exhaust()
+				i += len(self)
+				if i < 0:
+					raise IndexError('LazyList index out of range')
+			if i < self._evicted:
+				return self._get_evicted(i)
+			return self._data[i - self._evicted]
+		return super(WindowedLazyList, self).__getitem__(i)
+
+	def computed(self):
+		"""Return an iterator over the computed values still held in memory."""
+		return self[self._evicted:len(self)]
+
+	def _extend(self, values):
+		data = self._data
+		window = data.maxlen
+		for value in values:
+			if len(data) == window:
+				self._evict(data.popleft())
+			data.append(value)
+
+	def _evict(self, value):
+		if self._spill is not None:
+			with self._lock:
+				self._spill.seek(0, os.SEEK_END)
+				self._spillOffsets.append(self._spill.tell())
+				cPickle.dump(value, self._spill, cPickle.HIGHEST_PROTOCOL)
+		self._evicted += 1
+
+	def _get_evicted(self, i):
+		if self._spill is None:
+			raise EvictedError('index %d was evicted, only %d to %d are held' % (
+				i, self._evicted, len(self) - 1
+			))
+		with self._lock:
+			self._spill.seek(self._spillOffsets[i])
+			return cPickle.load(self._spill)
 
 
 class RecursiveLazyList(LazyList):
@@ -373,6 +1311,37 @@ def lazylist(gen):
 	return RecursiveLazyListFactory(gen)
 
 
+class RecursiveWindowedLazyList(WindowedLazyList):
+
+	def __init__(self, prod, window, *args, **kwds):
+		super(RecursiveWindowedLazyList, self).__init__(prod(self, *args, **kwds), window)
+
+
+def windowed_lazylist(window):
+	"""
+	Decorator like lazylist for producers that only look back a fixed
+	distance, keeping only the last window values so the list can run over
+	unbounded streams in constant memory.
+
+	>>> @windowed_lazylist(3)
+	... def fibgen(lst):
+	... 	yield 0
+	... 	yield 1
+	... 	for a, b in itertools.izip(lst, lst[1:]):
+	... 		yield a + b
+	...
+	>>> fibs = fibgen()
+	>>> print fibs[10], len(fibs._data)
+	55 3
+	>>> print fibs[100]
+	354224848179261915075
+	"""
+
+	def decorator(gen):
+		return functools.partial(RecursiveWindowedLazyList, gen, window)
+	return decorator
+
+
 def map_func(f):
 	"""
 	>>> import misc
@@ -585,6 +1554,91 @@ def pushback_itr(itr):
 				maybePushedBack = yield item
 
 
+class PushbackIterator(object):
+	"""
+	Iterator that values can be pushed back onto or peeked at, without
+	pushback_itr's extra generator resume and None per pushback
+
+	>>> itr = PushbackIterator(xrange(5))
+	>>> itr.next(), itr.next()
+	(0, 1)
+	>>> itr.push(10)
+	>>> itr.next(), itr.next()
+	(10, 2)
+	>>> itr.push(20)
+	>>> itr.push(30)
+	>>> itr.next(), itr.next()
+	(30, 20)
+	>>> itr.peek(), itr.peek(3)
+	(3, [3, 4])
+	>>> itr.push_many(["a", "b"])
+	>>> list(itr)
+	['a', 'b', 3, 4]
+	>>> itr.peek()
+	Traceback (most recent call last):
+	StopIteration
+	>>> itr.push("c")
+	>>> list(itr)
+	['c']
+	"""
+
+	def __init__(self, iterable):
+		self._iterator = iter(iterable)
+		self._buffer = collections.deque()
+		self._values = self._generate()
+		# push(item) makes item the next value returned; bound straight to the
+		# deque to skip a Python level call per pushback
+		self.push = self._buffer.appendleft
+
+	def __iter__(self):
+		# Loops run through a generator so the common case of an empty buffer
+		# is a generator resume rather than a Python method call
+		return self._values
+
+	def next(self):
+		if self._buffer:
+			return self._buffer.popleft()
+		return self._values.next()
+
+	def push_many(self, items):
+		"""Make items the next values returned, in their current order"""
+		self._buffer.extendleft(reversed(items))
+
+	def peek(self, n = None):
+		"""
+		Look at the next value without consuming it, or with n, a list of up to
+		the next n values
+		"""
+		buffer = self._buffer
+		iterator = self._iterator
+		if n is None:
+			if not buffer:
+				buffer.append(iterator.next())
+			return buffer[0]
+
+		try:
+			while len(buffer) < n:
+				buffer.append(iterator.next())
+		except StopIteration:
+			pass
+		return list(itertools.islice(buffer, n))
+
+	def _generate(self):
+		buffer = self._buffer
+		while True:
+			while buffer:
+				yield buffer.popleft()
+			for item in self._iterator:
+				yield item
+				if buffer:
+					break
+			else:
+				if not buffer:
+					# Restart so values pushed after the end still come out
+					self._values = self._generate()
+					return
+
+
 def itr_available(queue, initiallyBlock = False):
 	if initiallyBlock:
 		yield queue.get()
@@ -592,6 +1646,264 @@ def itr_available(queue, initiallyBlock = False):
 		yield queue.get_nowait()
 
 
+def drain(queue, max_items = None, timeout = 0):
+	"""
+	Take up to max_items from a Queue.Queue under a single acquisition of its
+	lock, returning them as a list.  Waits up to timeout seconds for the
+	first item (None waits forever, 0 doesn't wait) and then takes whatever
+	else is available, for micro-batching consumers.
+
+	>>> q = Queue.Queue()
+	>>> for i in xrange(5):
+	... 	q.put(i)
+	>>> drain(q, 2), drain(q), drain(q)
+	([0, 1], [2, 3, 4], [])
+	>>> drain(q, timeout=0.01)
+	[]
+	>>> t = threading.Timer(0.01, q.put, ("late", ))
+	>>> t.start()
+	>>> drain(q, timeout=None)
+	['late']
+	>>> lq = Queue.LifoQueue()
+	>>> for i in xrange(3):
+	... 	lq.put(i)
+	>>> drain(lq, 2), drain(lq)
+	([2, 1], [0])
+	"""
+	with queue.not_empty:
+		if timeout is None:
+			while not queue._qsize():
+				queue.not_empty.wait()
+		elif 0 < timeout:
+			endTime = time.time() + timeout
+			while not queue._qsize():
+				remaining = endTime - time.time()
+				if remaining <= 0:
+					break
+				queue.not_empty.wait(remaining)
+
+		available = queue._qsize()
+		count = available if max_items is None else min(max_items, available)
+		if count == available and type(queue.queue) is collections.deque:
+			# Swap the whole buffer out rather than popping item by item
+			items = list(queue.queue)
+			queue.queue = collections.deque()
+		else:
+			items = [queue._get() for i in xrange(count)]
+		if count:
+			queue.not_full.notify(count)
+	return items
+
+
+def _key_bytes(key):
+	"""
+	Encode key so that keys comparing equal encode the same.  Supports str,
+	unicode, int, long, bool, float, None, datetime's date, datetime, time
+	and timedelta, and tuples and frozensets (or sets) of those.
+
+	>>> _key_bytes(5) == _key_bytes(5L) == _key_bytes(5.0) == _key_bytes(True + 4)
+	True
+	>>> _key_bytes(("a", 1)) == _key_bytes((u"a", 1L))
+	True
+	>>> _key_bytes(("ab", "c")) == _key_bytes(("a", "bc"))
+	False
+	>>> _key_bytes(frozenset([1, "a"])) == _key_bytes(frozenset(["a", 1.0]))
+	True
+	>>> _key_bytes(datetime.date(2011, 1, 1)) == _key_bytes(datetime.datetime(2011, 1, 1))
+	False
+	>>> class Offset(datetime.tzinfo):
+	... 	def __init__(self, hours):
+	... 		self._offset = datetime.timedelta(hours=hours)
+	... 	def utcoffset(self, dt):
+	... 		return self._offset
+	>>> eastern = datetime.datetime(2011, 1, 1, 7, tzinfo=Offset(-5))
+	>>> utc = datetime.datetime(2011, 1, 1, 12, tzinfo=Offset(0))
+	>>> eastern == utc, _key_bytes(eastern) == _key_bytes(utc)
+	(True, True)
+	>>> _key_bytes(object())
+	Traceback (most recent call last):
+	...
+	TypeError: Unsupported key type object
+	"""
+	if isinstance(key, str):
+		return key
+	elif isinstance(key, unicode):
+		return key.encode("utf-8")
+	elif isinstance(key, (int, long)):
+		return "\0i%d" % key
+	elif isinstance(key, float):
+		if key.is_integer():
+			return "\0i%d" % key
+		return "\0f" + repr(key)
+	elif isinstance(key, tuple):
+		parts = ["\0t"]
+		for item in key:
+			item = _key_bytes(item)
+			parts.append(struct.pack("<I", len(item)))
+			parts.append(item)
+		return "".join(parts)
+	elif isinstance(key, (frozenset, set)):
+		# Sorted by encoding so iteration order doesn't matter
+		parts = ["\0s"]
+		for item in sorted(_key_bytes(item) for item in key):
+			parts.append(struct.pack("<I", len(item)))
+			parts.append(item)
+		return "".join(parts)
+	elif key is None:
+		return "\0n"
+	elif isinstance(key, datetime.datetime):
+		offset = key.utcoffset()
+		if offset is None:
+			return "\0T" + key.isoformat()
+		# Aware datetimes are equal when they are the same instant
+		return "\0Z" + (key - offset).replace(tzinfo=None).isoformat()
+	elif isinstance(key, (datetime.date, datetime.time)):
+		return ("\0d" if isinstance(key, datetime.date) else "\0h") + key.isoformat()
+	elif isinstance(key, datetime.timedelta):
+		return "\0D%d,%d,%d" % (key.days, key.seconds, key.microseconds)
+	else:
+		raise TypeError("Unsupported key type %s" % type(key).__name__)
+
+
+def _base_hashes(key):
+	"""
+	Two independent 64 bit hashes of key, stable across processes and platforms
+
+	>>> _base_hashes("Alabama") == _base_hashes(u"Alabama")
+	True
+	>>> _base_hashes(5) == _base_hashes(5L)
+	True
+	"""
+	return struct.unpack("<QQ", hashlib.md5(_key_bytes(key)).digest())
+
+
+def _probe_positions(key, numProbes, numBits):
+	"""
+	Enhanced double hashing (Kirsch-Mitzenmacher with the cubic term from
+	Dillinger-Manolios): derive numProbes bit positions from two base hashes
+	as (h1 + i * h2 + (i ** 3 - i) / 6) mod numBits.  The cubic term keeps
+	probes from cycling when h2 shares a factor with numBits.
+
+	>>> list(_probe_positions("Alabama", 4, 64)) == list(_probe_positions("Alabama", 4, 64))
+	True
+	>>> all(0 <= p < 64 for p in _probe_positions("Alabama", 14, 64))
+	True
+	"""
+	h1, h2 = _base_hashes(key)
+	start = h1 % numBits
+	step = h2 % numBits
+	for i in xrange(numProbes):
+		yield (start + i * step + (i ** 3 - i) // 6 % numBits) % numBits
+
+
+_PROBE_BATCH_SIZE = 1 << 14
+
+
+def _base_hash_batches(keys):
+	"""Yield lists of _base_hashes for up to _PROBE_BATCH_SIZE keys at a time"""
+	keys = iter(keys)
+	while True:
+		hashes = [_base_hashes(key) for key in itertools.islice(keys, _PROBE_BATCH_SIZE)]
+		if not hashes:
+			return
+		yield hashes
+
+
+def _bulk_probe_positions(keys, numProbes, numBits):
+	"""
+	Compute the probe positions for batches of keys at once, yielding one
+	sequence of positions per batch, laid out key by key.  Uses NumPy when
+	available, otherwise a flat array.
+
+	Positions are identical to _probe_positions
+
+	>>> keys = ["Alabama", "Alaska", u"Arizona", 5]
+	>>> expected = [p for key in keys for p in _probe_positions(key, 3, 64)]
+	>>> [list(batch) for batch in _bulk_probe_positions(keys, 3, 64)] == [expected]
+	True
+	"""
+	for hashes in _base_hash_batches(keys):
+		if numpy is not None:
+			hashes = numpy.array(hashes, dtype=numpy.uint64)
+			# Reduce before combining so nothing wraps around 2 ** 64
+			starts = hashes[:, 0] % numpy.uint64(numBits)
+			steps = hashes[:, 1] % numpy.uint64(numBits)
+			offsets = numpy.arange(numProbes, dtype=numpy.uint64)
+			cubics = numpy.array(
+				[(i ** 3 - i) // 6 % numBits for i in xrange(numProbes)],
+				dtype=numpy.uint64,
+			)
+			positions = (starts[:, None] + steps[:, None] * offsets + cubics) % numpy.uint64(numBits)
+			yield positions.ravel()
+		else:
+			cubics = [(i ** 3 - i) // 6 % numBits for i in xrange(numProbes)]
+			positions = array.array("L")
+			for h1, h2 in hashes:
+				start = h1 % numBits
+				step = h2 % numBits
+				positions.extend(
+					(start + i * step + cubic) % numBits
+					for i, cubic in enumerate(cubics)
+				)
+			yield positions
+
+
+class _ByteView(object):
+	"""
+	Read-only integer view of a byte buffer, for mapped files when NumPy is
+	not available
+
+	>>> view = _ByteView("\\x01\\xff")
+	>>> len(view), view[0], view[1], list(view)
+	(2, 1, 255, [1, 255])
+	"""
+
+	def __init__(self, buf, offset = 0):
+		self._buf = buffer(buf, offset)
+
+	def __len__(self):
+		return len(self._buf)
+
+	def __getitem__(self, i):
+		return ord(self._buf[i])
+
+	def __iter__(self):
+		return itertools.imap(ord, self._buf)
+
+	def tostring(self):
+		return str(self._buf)
+
+
+def _combine_bits(target, source, combine):
+	"""
+	Combine source into target in place with a bitwise operator, a machine
+	word (NumPy) or the whole array (long integers) at a time instead of byte
+	by byte
+
+	>>> import operator
+	>>> target = array.array('B', [0x0f, 0x00, 0xf0, 0x01])
+	>>> _combine_bits(target, array.array('B', [0xf0, 0x00, 0x0f, 0x03]), operator.or_)
+	>>> list(target)
+	[255, 0, 255, 3]
+	>>> _combine_bits(target, array.array('B', [0xf0, 0x00, 0x0f, 0x02]), operator.and_)
+	>>> list(target)
+	[240, 0, 15, 2]
+	"""
+	if numpy is not None:
+		targetWords = numpy.frombuffer(target, dtype=numpy.uint32)
+		sourceWords = numpy.frombuffer(source, dtype=numpy.uint32)
+		{
+			operator.or_: numpy.bitwise_or,
+			operator.and_: numpy.bitwise_and,
+		}[combine](targetWords, sourceWords, out=targetWords)
+	else:
+		numBytes = len(target)
+		targetBits = long(binascii.hexlify(target.tostring()), 16)
+		sourceBits = long(binascii.hexlify(source.tostring()), 16)
+		combined = "%0*x" % (numBytes * 2, combine(targetBits, sourceBits))
+		target[:] = array.array('B', binascii.unhexlify(combined))
+
+
 class BloomFilter(object):
 	"""
 	http://en.wikipedia.org/wiki/Bloom_filter
@@ -618,45 +1930,1137 @@ class BloomFilter(object):
 	>>> numGarbageFound = sum(''.join(sample(ascii_letters, 5)) in bf for i in range(trials))
 	>>> numGarbageFound, trials
 	(0, 100)
+	>>> bulk = BloomFilter(num_bits=1000, num_probes=14)
+	>>> bulk.add_many(states)
+	>>> bulk._arr == bf._arr
+	True
+	>>> all(bulk.contains_many(states))
+	True
+	>>> bulk.contains_many(["Alabama", "Atlantis"])
+	[True, False]
+
+	Keys may be str, unicode, numbers, None, dates, times and timedeltas, or
+	tuples and frozensets of those, and keys comparing equal are found
+	alike.  Any other key raises TypeError; this goes for every filter and
+	sketch in this module.
+
+	>>> bf.add(5L)
+	>>> 5 in bf, datetime.date(2011, 1, 1) in bf
+	(True, False)
+	>>> bf.add(object())
+	Traceback (most recent call last):
+	...
+	TypeError: Unsupported key type object
 	"""
 
+	_HEADER = struct.Struct("<4sBB2xQI4x")
+	_MAGIC = "BLMF"
+	_VERSION = 1
+
+	# Identifies _probe_positions in saved filters; bump when it changes
+	HASH_SCHEME = 1
+
 	def __init__(self, num_bits, num_probes):
 		num_words = (num_bits + 31) // 32
-		self._arr = array.array('B', [0]) * num_words
+		self._num_bits = num_words * 32
+		self._arr = array.array('B', [0]) * (num_words * 4)
 		self._num_probes = num_probes
+		self._mmap = None
+
+	@property
+	def num_bits(self):
+		return self._num_bits
+
+	@property
+	def num_probes(self):
+		return self._num_probes
+
+	def save(self, path):
+		"""
+		Write the filter as a small header followed by the raw bit array
+
+		>>> import os, tempfile
+		>>> bf = BloomFilter(num_bits=1000, num_probes=7)
+		>>> bf.add_many(["Alabama", "Alaska"])
+		>>> fd, path = tempfile.mkstemp()
+		>>> os.close(fd)
+		>>> bf.save(path)
+		>>> mapped = BloomFilter.open(path)
+		>>> "Alabama" in mapped, "Arizona" in mapped
+		(True, False)
+		>>> mapped.contains_many(["Alaska", "Arizona"])
+		[True, False]
+		>>> mapped.add("Arizona")
+		Traceback (most recent call last):
+		TypeError: Cannot modify a read-only bloom filter
+		>>> copied = BloomFilter.open(path, mmap=False)
+		>>> copied.add("Arizona")
+		>>> copied.intersection(mapped)
+		>>> "Arizona" in copied, "Alaska" in copied
+		(False, True)
+		>>> del mapped
+		>>> os.remove(path)
+		"""
+		with open(path, "wb") as f:
+			f.write(self._HEADER.pack(
+				self._MAGIC, self._VERSION, self.HASH_SCHEME, self._num_bits, self._num_probes
+			))
+			f.write(self._arr.tostring())
+
+	@classmethod
+	def open(cls, path, mmap = True):
+		"""
+		Load a filter written by save.  With mmap the bits are mapped read-only
+		so processes opening the same file share one copy in the page cache.
+		"""
+		with open(path, "rb") as f:
+			header = f.read(cls._HEADER.size)
+			if len(header) != cls._HEADER.size:
+				raise ValueError("Truncated bloom filter header in %s" % path)
+			magic, version, hashScheme, numBits, numProbes = cls._HEADER.unpack(header)
+			if magic != cls._MAGIC or version != cls._VERSION:
+				raise ValueError("%s is not a bloom filter" % path)
+			if hashScheme != cls.HASH_SCHEME:
+				raise ValueError("Unsupported hash scheme %d in %s" % (hashScheme, path))
+
+			bfilter = cls.__new__(cls)
+			bfilter._num_bits = numBits
+			bfilter._num_probes = numProbes
+			bfilter._mmap = None
+			if mmap:
+				bfilter._mmap = _mmap.mmap(f.fileno(), 0, access=_mmap.ACCESS_READ)
+				if numpy is not None:
+					bfilter._arr = numpy.frombuffer(
+						bfilter._mmap, dtype=numpy.uint8, offset=cls._HEADER.size
+					)
+				else:
+					bfilter._arr = _ByteView(bfilter._mmap, cls._HEADER.size)
+			else:
+				bfilter._arr = array.array('B')
+				bfilter._arr.fromfile(f, numBits // 8)
+		if len(bfilter._arr) * 8 != numBits:
+			raise ValueError("Truncated bloom filter bits in %s" % path)
+		return bfilter
 
 	def add(self, key):
+		self._check_writable()
+		arr = self._arr
 		for i, mask in self._get_probes(key):
-			self._arr[i] |= mask
+			arr[i] |= mask
+
+	def add_many(self, keys):
+		"""
+		Add every key in the iterable, computing probes a batch at a time.  Key
+		types are as for BloomFilter.
+		"""
+		self._check_writable()
+		arr = self._arr
+		for positions in _bulk_probe_positions(keys, self._num_probes, self._num_bits):
+			if numpy is not None:
+				view = numpy.frombuffer(arr, dtype=numpy.uint8)
+				masks = numpy.left_shift(1, positions & 7).astype(numpy.uint8)
+				numpy.bitwise_or.at(view, positions >> numpy.uint64(3), masks)
+			else:
+				for position in positions:
+					arr[position >> 3] |= 1 << (position & 7)
+
+	def contains_many(self, keys):
+		"""
+		Membership of each key in the iterable, as a list of bools.  Key types
+		are as for BloomFilter.
+		"""
+		arr = self._arr
+		numProbes = self._num_probes
+		results = []
+		for positions in _bulk_probe_positions(keys, numProbes, self._num_bits):
+			if numpy is not None:
+				view = numpy.frombuffer(arr, dtype=numpy.uint8)
+				masks = numpy.left_shift(1, positions & 7).astype(numpy.uint8)
+				hits = (view[positions >> numpy.uint64(3)] & masks).reshape(-1, numProbes)
+				results.extend(hits.all(axis=1).tolist())
+			else:
+				for offset in xrange(0, len(positions), numProbes):
+					results.append(all(
+						arr[position >> 3] & (1 << (position & 7))
+						for position in positions[offset:offset+numProbes]
+					))
+		return results
 
 	def union(self, bfilter):
+		self._check_writable()
 		if self._match_template(bfilter):
-			for i, b in enumerate(bfilter._arr):
-				self._arr[i] |= b
+			_combine_bits(self._arr, bfilter._arr, operator.or_)
 		else:
 			# Union b/w two unrelated bloom filter raises this
 			raise ValueError("Mismatched bloom filters")
 
 	def intersection(self, bfilter):
+		self._check_writable()
 		if self._match_template(bfilter):
-			for i, b in enumerate(bfilter._arr):
-				self._arr[i] &= b
+			_combine_bits(self._arr, bfilter._arr, operator.and_)
 		else:
 			# Intersection b/w two unrelated bloom filter raises this
 			raise ValueError("Mismatched bloom filters")
 
 	def __contains__(self, key):
-		return all(self._arr[i] & mask for i, mask in self._get_probes(key))
+		arr = self._arr
+		for i, mask in self._get_probes(key):
+			if not arr[i] & mask:
+				return False
+		return True
 
 	def _match_template(self, bfilter):
 		return self.num_bits == bfilter.num_bits and self.num_probes == bfilter.num_probes
 
+	def _check_writable(self):
+		if self._mmap is not None:
+			raise TypeError("Cannot modify a read-only bloom filter")
+
 	def _get_probes(self, key):
-		hasher = random.Random(key).randrange
-		for _ in range(self._num_probes):
-			array_index = hasher(len(self._arr))
-			bit_index = hasher(32)
-			yield array_index, 1 << bit_index
+		for position in _probe_positions(key, self._num_probes, self._num_bits):
+			yield position >> 3, 1 << (position & 7)
+
+
+def _bloom_shard_worker(numBits, numProbes, chunks, results):
+	try:
+		bfilter = BloomFilter(numBits, numProbes)
+		for chunk in iter(chunks.get, None):
+			bfilter.add_many(chunk)
+		results.put((None, bfilter))
+	except Exception, e:
+		results.put((e, None))
+
+
+def build_bloom_filter(keys, num_bits, num_probes, processes = None, chunk_size = 10000):
+	"""
+	Build a BloomFilter across several processes, each filling its own filter
+	from chunks of keys before they get OR-merged together
+
+	>>> bf = build_bloom_filter(xrange(5000), num_bits=50000, num_probes=7, processes=2, chunk_size=100)
+	>>> serial = BloomFilter(num_bits=50000, num_probes=7)
+	>>> serial.add_many(xrange(5000))
+	>>> bf._arr == serial._arr
+	True
+
+	A worker's error is raised as soon as it is noticed
+
+	>>> build_bloom_filter([object()] * 200, 1000, 3, processes=2, chunk_size=10)
+	Traceback (most recent call last):
+	...
+	TypeError: Unsupported key type object
+	"""
+	if processes is None:
+		processes = multiprocessing.cpu_count()
+	bfilter = BloomFilter(num_bits, num_probes)
+	if processes <= 1:
+		bfilter.add_many(keys)
+		return bfilter
+
+	chunks = multiprocessing.Queue(processes * 2)
+	results = multiprocessing.Queue()
+	workers = [
+		multiprocessing.Process(
+			target=_bloom_shard_worker,
+			args=(bfilter.num_bits, bfilter.num_probes, chunks, results),
+		)
+		for i in xrange(processes)
+	]
+	for worker in workers:
+		worker.daemon = True
+		worker.start()
+
+	shards = []
+
+	def receive(timeout):
+		try:
+			shardError, shard = results.get(timeout=timeout)
+		except Queue.Empty:
+			return False
+		if shardError is not None:
+			raise shardError
+		shards.append(shard)
+		return True
+
+	def check_workers():
+		# Workers only exit after reporting, so more exits than reports
+		# means one was killed outright
+		while receive(0):
+			pass
+		exited = [worker for worker in workers if not worker.is_alive()]
+		if len(shards) < len(exited):
+			raise RuntimeError("build_bloom_filter worker exited with code %s" % (
+				exited[0].exitcode,
+			))
+
+	def send(chunk):
+		while True:
+			try:
+				chunks.put(chunk, timeout=_POOL_POLL_INTERVAL)
+				return
+			except Queue.Full:
+				check_workers()
+
+	isClean = False
+	try:
+		keys = iter(keys)
+		while True:
+			chunk = list(itertools.islice(keys, chunk_size))
+			if not chunk:
+				break
+			send(chunk)
+		for worker in workers:
+			send(None)
+		while len(shards) < processes:
+			if not receive(_POOL_POLL_INTERVAL):
+				check_workers()
+		for worker in workers:
+			worker.join()
+		isClean = True
+	finally:
+		if not isClean:
+			for worker in workers:
+				if worker.is_alive():
+					worker.terminate()
+			chunks.cancel_join_thread()
+
+	for shard in shards:
+		bfilter.union(shard)
+	return bfilter
+
+
+def _bloom_file_shard(args):
+	path, start, end, numBits, numProbes, chunkSize = args
+	bfilter = BloomFilter(numBits, numProbes)
+	with open(path, "rb") as f:
+		# A line belongs to the shard its first byte falls in, so skip the
+		# tail of the line straddling our start
+		if start:
+			f.seek(start - 1)
+			f.readline()
+		chunk = []
+		while f.tell() < end:
+			line = f.readline()
+			if not line:
+				break
+			chunk.append(line.rstrip("\r\n"))
+			if chunkSize <= len(chunk):
+				bfilter.add_many(chunk)
+				chunk = []
+		bfilter.add_many(chunk)
+	return bfilter
+
+
+def build_bloom_filter_from_file(path, num_bits, num_probes, processes = None, chunk_size = 10000):
+	"""
+	Build a BloomFilter over the lines of a file, with each process reading
+	its own byte range of the file directly
+
+	>>> import tempfile
+	>>> f = tempfile.NamedTemporaryFile()
+	>>> f.write("\\n".join(str(i) for i in xrange(5000)))
+	>>> f.flush()
+	>>> bf = build_bloom_filter_from_file(f.name, num_bits=50000, num_probes=7, processes=3)
+	>>> serial = BloomFilter(num_bits=50000, num_probes=7)
+	>>> serial.add_many(str(i) for i in xrange(5000))
+	>>> bf._arr == serial._arr
+	True
+	>>> f.close()
+	"""
+	if processes is None:
+		processes = multiprocessing.cpu_count()
+	bfilter = BloomFilter(num_bits, num_probes)
+	size = os.path.getsize(path)
+	# Oversplit so slow shards don't hold up the merge
+	numShards = max(1, min(processes * 4, size // (1 << 20) + 1))
+	bounds = [size * i // numShards for i in xrange(numShards + 1)]
+	shards = [
+		(path, start, end, bfilter.num_bits, bfilter.num_probes, chunk_size)
+		for start, end in itertools.izip(bounds, bounds[1:])
+	]
+	if processes <= 1 or numShards == 1:
+		for shard in shards:
+			bfilter.union(_bloom_file_shard(shard))
+		return bfilter
+
+	pool = multiprocessing.Pool(processes)
+	try:
+		for shard in pool.imap_unordered(_bloom_file_shard, shards):
+			bfilter.union(shard)
+	finally:
+		pool.close()
+		pool.join()
+	return bfilter
+
+
+def _bloom_dimensions(capacity, error_rate):
+	"""
+	Optimal (num_bits, num_probes) for holding capacity keys at error_rate
+
+	>>> _bloom_dimensions(1000, 0.01)
+	(9586, 7)
+	"""
+	num_bits = int(math.ceil(-capacity * math.log(error_rate) / math.log(2) ** 2))
+	num_probes = max(1, int(math.ceil(-math.log(error_rate, 2))))
+	return num_bits, num_probes
+
+
+def _bloom_error_rate(num_bits, num_probes, count):
+	"""Expected false positive rate of a bloom filter holding count keys"""
+	return (1.0 - math.exp(-float(num_probes) * count / num_bits)) ** num_probes
+
+
+class ScalableBloomFilter(object):
+	"""
+	A bloom filter that grows to keep its false positive rate under a target
+
+	Stacks BloomFilter layers, each growth_factor times larger than the last
+	with its error rate tightened by tightening_ratio, so the compounded rate
+	stays under error_rate no matter how many layers get added.
+
+	Source: Almeida, Baquero, Preguica, Hutchison "Scalable Bloom Filters"
+
+	>>> sbf = ScalableBloomFilter(initial_capacity=100, error_rate=0.001)
+	>>> for i in xrange(1000):
+	... 	sbf.add(i)
+	>>> all(i in sbf for i in xrange(1000))
+	True
+	>>> sbf.count, sbf.capacity
+	(1000, 1500)
+	>>> sbf.estimated_error_rate < 0.001
+	True
+	>>> sum(i in sbf for i in xrange(1000, 11000)) < 10
+	True
+	>>> bulk = ScalableBloomFilter(initial_capacity=100, error_rate=0.001)
+	>>> bulk.add_many(xrange(1000))
+	>>> bulk.add_many(xrange(500))
+	>>> bulk.count, bulk.capacity
+	(1000, 1500)
+	>>> all(bulk.contains_many(xrange(1000)))
+	True
+	"""
+
+	def __init__(self, initial_capacity, error_rate, growth_factor = 2, tightening_ratio = 0.5):
+		if not 0 < error_rate < 1:
+			raise ValueError("error_rate must be between 0 and 1")
+		self._initial_capacity = initial_capacity
+		self._error_rate = error_rate
+		self._growth_factor = growth_factor
+		self._tightening_ratio = tightening_ratio
+		self._filters = []
+		self._capacities = []
+		self._counts = []
+
+	@property
+	def capacity(self):
+		"""Number of keys the current layers hold before another is added"""
+		return sum(self._capacities)
+
+	@property
+	def count(self):
+		"""Number of distinct keys added, as far as the filter can tell"""
+		return sum(self._counts)
+
+	@property
+	def estimated_error_rate(self):
+		"""False positive rate for the keys currently held"""
+		passRate = 1.0
+		for bfilter, count in itertools.izip(self._filters, self._counts):
+			passRate *= 1.0 - _bloom_error_rate(bfilter._num_bits, bfilter._num_probes, count)
+		return 1.0 - passRate
+
+	def add(self, key):
+		if key in self:
+			return
+		self._current_layer()
+		self._filters[-1].add(key)
+		self._counts[-1] += 1
+
+	def add_many(self, keys):
+		"""
+		Add every key in the iterable, a layer's remaining capacity at a time.
+		Key types are as for BloomFilter.
+
+		Duplicates within a single batch are each counted, making the filter
+		grow slightly early rather than exceed its error rate.
+		"""
+		keys = iter(keys)
+		while True:
+			self._current_layer()
+			room = self._capacities[-1] - self._counts[-1]
+			batch = list(itertools.islice(keys, min(room, _PROBE_BATCH_SIZE)))
+			if not batch:
+				return
+			present = self.contains_many(batch)
+			batch = [key for key, isPresent in itertools.izip(batch, present) if not isPresent]
+			self._filters[-1].add_many(batch)
+			self._counts[-1] += len(batch)
+
+	def contains_many(self, keys):
+		"""
+		Membership of each key in the iterable, as a list of bools.  Key types
+		are as for BloomFilter.
+		"""
+		keys = list(keys)
+		results = [False] * len(keys)
+		for bfilter in reversed(self._filters):
+			missing = [i for i, isPresent in enumerate(results) if not isPresent]
+			if not missing:
+				break
+			found = bfilter.contains_many(keys[i] for i in missing)
+			for i, isPresent in itertools.izip(missing, found):
+				results[i] = isPresent
+		return results
+
+	def __contains__(self, key):
+		# Newest layers are the largest, so most likely to hold the key
+		for bfilter in reversed(self._filters):
+			if key in bfilter:
+				return True
+		return False
+
+	def _current_layer(self):
+		if self._filters and self._counts[-1] < self._capacities[-1]:
+			return
+		layer = len(self._filters)
+		capacity = self._initial_capacity * self._growth_factor ** layer
+		errorRate = self._error_rate * (1 - self._tightening_ratio) * self._tightening_ratio ** layer
+		self._filters.append(BloomFilter(*_bloom_dimensions(capacity, errorRate)))
+		self._capacities.append(capacity)
+		self._counts.append(0)
+
+
+class CountingBloomFilter(object):
+	"""
+	A bloom filter that supports removal by keeping a 4 bit counter per slot,
+	packed two to a byte.  Counters saturate at 15 and then stay put, since
+	decrementing them could drop keys that are still present.
+
+	>>> cbf = CountingBloomFilter(num_counters=1000, num_probes=7)
+	>>> for word in "alpha beta gamma delta".split():
+	... 	cbf.add(word)
+	>>> "beta" in cbf, "epsilon" in cbf
+	(True, False)
+	>>> cbf.remove("beta")
+	>>> "beta" in cbf, "alpha" in cbf
+	(False, True)
+	>>> cbf.remove("beta")
+	Traceback (most recent call last):
+	KeyError: 'beta'
+	>>> other = CountingBloomFilter(num_counters=1000, num_probes=7)
+	>>> other.add("epsilon")
+	>>> cbf.union(other)
+	>>> "epsilon" in cbf
+	True
+	>>> cbf.remove("epsilon")
+	>>> "epsilon" in cbf, "gamma" in cbf
+	(False, True)
+	"""
+
+	MAX_COUNT = 0xF
+
+	def __init__(self, num_counters, num_probes):
+		self._num_counters = num_counters + (num_counters & 1)
+		self._arr = array.array('B', [0]) * (self._num_counters // 2)
+		self._num_probes = num_probes
+
+	def add(self, key):
+		for position in _probe_positions(key, self._num_probes, self._num_counters):
+			self._increment(position, 1)
+
+	def add_many(self, keys):
+		"""
+		Add every key in the iterable, computing probes a batch at a time.  Key
+		types are as for BloomFilter.
+		"""
+		for positions in _bulk_probe_positions(keys, self._num_probes, self._num_counters):
+			for position in positions:
+				self._increment(position, 1)
+
+	def remove(self, key):
+		if key not in self:
+			raise KeyError(key)
+		arr = self._arr
+		for position in _probe_positions(key, self._num_probes, self._num_counters):
+			i, shift = position >> 1, (position & 1) << 2
+			count = (arr[i] >> shift) & 0xF
+			if count != self.MAX_COUNT:
+				arr[i] -= 1 << shift
+
+	def union(self, bfilter):
+		if self._match_template(bfilter):
+			for position in xrange(self._num_counters):
+				i, shift = position >> 1, (position & 1) << 2
+				self._increment(position, (bfilter._arr[i] >> shift) & 0xF)
+		else:
+			# Union b/w two unrelated bloom filter raises this
+			raise ValueError("Mismatched bloom filters")
+
+	def __contains__(self, key):
+		arr = self._arr
+		for position in _probe_positions(key, self._num_probes, self._num_counters):
+			if not (arr[position >> 1] >> ((position & 1) << 2)) & 0xF:
+				return False
+		return True
+
+	def _match_template(self, bfilter):
+		return (
+			self._num_counters == bfilter._num_counters and
+			self._num_probes == bfilter._num_probes
+		)
+
+	def _increment(self, position, amount):
+		arr = self._arr
+		i, shift = position >> 1, (position & 1) << 2
+		count = (arr[i] >> shift) & 0xF
+		newCount = min(count + amount, self.MAX_COUNT)
+		arr[i] += (newCount - count) << shift
+
+
+class CuckooFilterFullError(RuntimeError):
+	"""A CuckooFilter has no room left for another key"""
+
+
+class CuckooFilter(object):
+	"""
+	Membership filter storing a short fingerprint per key in one of two
+	candidate buckets.  For low false positive rates it is smaller than a
+	BloomFilter and, unlike one, it supports removal.  The false positive
+	rate is about 2 * bucket_size / 2 ** fingerprint_bits.
+
+	Source: Fan, Andersen, Kaminsky, Mitzenmacher "Cuckoo Filter:
+	Practically Better Than Bloom"
+
+	>>> cf = CuckooFilter(capacity=1000)
+	>>> for i in xrange(1000):
+	... 	cf.add(i)
+	>>> all(i in cf for i in xrange(1000)), cf.count
+	(True, 1000)
+	>>> sum(i in cf for i in xrange(1000, 11000)) < 30
+	True
+	>>> cf.remove(5)
+	>>> 5 in cf, 6 in cf
+	(False, True)
+	>>> cf.remove(5)
+	Traceback (most recent call last):
+	KeyError: 5
+	>>> bulk = CuckooFilter(capacity=1000)
+	>>> bulk.add_many(xrange(1000))
+	>>> bulk.contains_many([1, 999, "nope"])
+	[True, True, False]
+
+	Like BloomFilter.add, adding a key already present changes nothing.  Keys
+	sharing a fingerprint and bucket are stored once, so only remove keys
+	that were added.
+
+	>>> same = CuckooFilter(capacity=1000)
+	>>> for i in xrange(9):
+	... 	same.add("same")
+	>>> same.add_many(["same", "same"])
+	>>> same.count
+	1
+
+	Removing keys from a full filter makes room again
+
+	>>> tiny = CuckooFilter(capacity=8, bucket_size=2)
+	>>> added = []
+	>>> for i in xrange(100):
+	... 	tiny.add(i)
+	... 	added.append(i)
+	Traceback (most recent call last):
+	CuckooFilterFullError: Cuckoo filter is full
+	>>> for i in added[:4]:
+	... 	tiny.remove(i)
+	>>> tiny.add(1000)
+	>>> all(i in tiny for i in added[4:] + [1000])
+	True
+	"""
+
+	_FINGERPRINT_MIX = 0x5bd1e995
+	# Insertion starts failing somewhere past 95% full with 4 slot buckets
+	_MAX_LOAD = 0.9
+
+	def __init__(self, capacity, bucket_size = 4, fingerprint_bits = 12, max_kicks = 500):
+		if not 1 <= fingerprint_bits <= 32:
+			raise ValueError("fingerprint_bits must be between 1 and 32")
+		# Power of two bucket counts let _alt_index work by XOR
+		numBuckets = 1
+		while numBuckets * bucket_size * self._MAX_LOAD < capacity:
+			numBuckets <<= 1
+		self._num_buckets = numBuckets
+		self._bucket_size = bucket_size
+		self._fingerprint_mask = (1 << fingerprint_bits) - 1
+		self._max_kicks = max_kicks
+		typecode = 'B' if fingerprint_bits <= 8 else 'H' if fingerprint_bits <= 16 else 'I'
+		self._arr = array.array(typecode, [0]) * (numBuckets * bucket_size)
+		# A fingerprint that couldn't be placed, so no key is ever lost
+		self._victim = None
+		self._count = 0
+		self._random = random.Random(0)
+
+	@property
+	def count(self):
+		return self._count
+
+	def add(self, key):
+		index, fingerprint = self._index_fingerprint(*_base_hashes(key))
+		self._add(index, fingerprint)
+
+	def add_many(self, keys):
+		"""
+		Add every key in the iterable, hashing a batch at a time.  Key types
+		are as for BloomFilter.
+		"""
+		for hashes in _base_hash_batches(keys):
+			for h1, h2 in hashes:
+				index, fingerprint = self._index_fingerprint(h1, h2)
+				self._add(index, fingerprint)
+
+	def remove(self, key):
+		index, fingerprint = self._index_fingerprint(*_base_hashes(key))
+		altIndex = self._alt_index(index, fingerprint)
+		if self._victim is not None and self._victim[1] == fingerprint and self._victim[0] in (index, altIndex):
+			self._victim = None
+			self._count -= 1
+			return
+		arr = self._arr
+		for bucket in (index, altIndex):
+			start = bucket * self._bucket_size
+			for slot in xrange(start, start + self._bucket_size):
+				if arr[slot] == fingerprint:
+					arr[slot] = 0
+					self._count -= 1
+					if self._victim is not None:
+						# There's room for it now, somewhere
+						victimIndex, victimFingerprint = self._victim
+						self._victim = None
+						self._count -= 1
+						self._insert(victimIndex, victimFingerprint)
+					return
+		raise KeyError(key)
+
+	def __contains__(self, key):
+		index, fingerprint = self._index_fingerprint(*_base_hashes(key))
+		return self._lookup(index, fingerprint)
+
+	def contains_many(self, keys):
+		"""
+		Membership of each key in the iterable, as a list of bools.  Key types
+		are as for BloomFilter.
+		"""
+		results = []
+		for hashes in _base_hash_batches(keys):
+			if numpy is not None:
+				hashes = numpy.array(hashes, dtype=numpy.uint64)
+				indices = hashes[:, 0] & numpy.uint64(self._num_buckets - 1)
+				fingerprints = hashes[:, 1] & numpy.uint64(self._fingerprint_mask)
+				fingerprints[fingerprints == 0] = 1
+				altIndices = indices ^ (
+					(fingerprints * numpy.uint64(self._FINGERPRINT_MIX)) & numpy.uint64(self._num_buckets - 1)
+				)
+				buckets = numpy.frombuffer(self._arr, dtype=numpy.dtype(self._arr.typecode)).reshape(
+					self._num_buckets, self._bucket_size
+				)
+				found = (
+					(buckets[indices] == fingerprints[:, None]).any(axis=1) |
+					(buckets[altIndices] == fingerprints[:, None]).any(axis=1)
+				)
+				if self._victim is not None:
+					victimIndex, victimFingerprint = self._victim
+					found |= (fingerprints == victimFingerprint) & (
+						(indices == victimIndex) | (altIndices == victimIndex)
+					)
+				results.extend(found.tolist())
+			else:
+				for h1, h2 in hashes:
+					results.append(self._lookup(*self._index_fingerprint(h1, h2)))
+		return results
+
+	def _index_fingerprint(self, h1, h2):
+		# 0 marks an empty slot
+		fingerprint = (h2 & self._fingerprint_mask) or 1
+		return h1 & (self._num_buckets - 1), fingerprint
+
+	def _alt_index(self, index, fingerprint):
+		# XOR keeps this symmetric, so either index leads to the other
+		return index ^ ((fingerprint * self._FINGERPRINT_MIX) & (self._num_buckets - 1))
+
+	def _lookup(self, index, fingerprint):
+		arr = self._arr
+		bucketSize = self._bucket_size
+		altIndex = self._alt_index(index, fingerprint)
+		for bucket in (index, altIndex):
+			start = bucket * bucketSize
+			for slot in xrange(start, start + bucketSize):
+				if arr[slot] == fingerprint:
+					return True
+		victim = self._victim
+		return victim is not None and victim[1] == fingerprint and victim[0] in (index, altIndex)
+
+	def _add(self, index, fingerprint):
+		if self._lookup(index, fingerprint):
+			return
+		if self._victim is not None:
+			raise CuckooFilterFullError("Cuckoo filter is full")
+		self._insert(index, fingerprint)
+
+	def _insert(self, index, fingerprint):
+		arr = self._arr
+		bucketSize = self._bucket_size
+		for bucket in (index, self._alt_index(index, fingerprint)):
+			start = bucket * bucketSize
+			for slot in xrange(start, start + bucketSize):
+				if not arr[slot]:
+					arr[slot] = fingerprint
+					self._count += 1
+					return
+
+		bucket = self._random.choice((index, self._alt_index(index, fingerprint)))
+		for dummy in xrange(self._max_kicks):
+			slot = bucket * bucketSize + self._random.randrange(bucketSize)
+			fingerprint, arr[slot] = arr[slot], fingerprint
+			bucket = self._alt_index(bucket, fingerprint)
+			start = bucket * bucketSize
+			for slot in xrange(start, start + bucketSize):
+				if not arr[slot]:
+					arr[slot] = fingerprint
+					self._count += 1
+					return
+		self._victim = bucket, fingerprint
+		self._count += 1
+
+
+def _read_sketch_header(f, header, magic, version, path):
+	data = f.read(header.size)
+	if len(data) != header.size:
+		raise ValueError("Truncated header in %s" % path)
+	fields = header.unpack(data)
+	if fields[0] != magic or fields[1] != version:
+		raise ValueError("%s is not a %s file" % (path, magic))
+	if fields[2] != BloomFilter.HASH_SCHEME:
+		raise ValueError("Unsupported hash scheme %d in %s" % (fields[2], path))
+	return fields[3:]
+
+
+def _bit_length(values, numBits):
+	"""Vectorized int.bit_length for an array of unsigned NumPy integers"""
+	lengths = numpy.zeros(len(values), dtype=numpy.uint8)
+	values = values.copy()
+	shift = 1 << (numBits - 1).bit_length()
+	while shift:
+		shift >>= 1
+		if not shift:
+			break
+		hasHigh = (values >> numpy.uint64(shift)) != 0
+		lengths[hasHigh] += shift
+		values[hasHigh] >>= numpy.uint64(shift)
+	lengths[values != 0] += 1
+	return lengths
+
+
+class HyperLogLog(object):
+	"""
+	Estimate the number of distinct keys with 2 ** precision one byte
+	registers, a standard error of about 1.04 / sqrt(2 ** precision)
+
+	Source: Flajolet, Fusy, Gandouet, Meunier "HyperLogLog: the analysis of a
+	near-optimal cardinality estimation algorithm"
+
+	>>> hll = HyperLogLog(precision=12)
+	>>> for i in xrange(10000):
+	... 	hll.add(i % 5000)
+	>>> abs(hll.estimate() - 5000) < 5000 * 0.05
+	True
+	>>> bulk = HyperLogLog(precision=12)
+	>>> bulk.add_many(xrange(5000))
+	>>> bulk._registers == hll._registers
+	True
+	>>> other = HyperLogLog(precision=12)
+	>>> other.add_many(xrange(2500, 7500))
+	>>> hll.merge(other)
+	>>> abs(hll.estimate() - 7500) < 7500 * 0.05
+	True
+	>>> HyperLogLog(precision=12).estimate()
+	0.0
+	"""
+
+	_HEADER = struct.Struct("<4sBB2xI")
+	_MAGIC = "HLLG"
+	_VERSION = 1
+
+	def __init__(self, precision = 14):
+		if not 4 <= precision <= 18:
+			raise ValueError("precision must be between 4 and 18")
+		self._precision = precision
+		self._registers = array.array('B', [0]) * (1 << precision)
+
+	@property
+	def precision(self):
+		return self._precision
+
+	def add(self, key):
+		h1, h2 = _base_hashes(key)
+		index, rank = self._index_rank(h1)
+		if self._registers[index] < rank:
+			self._registers[index] = rank
+
+	def add_many(self, keys):
+		"""
+		Add every key in the iterable, hashing a batch at a time.  Key types
+		are as for BloomFilter.
+		"""
+		registers = self._registers
+		restBits = 64 - self._precision
+		for hashes in _base_hash_batches(keys):
+			if numpy is not None:
+				hashes = numpy.array(hashes, dtype=numpy.uint64)[:, 0]
+				indices = hashes >> numpy.uint64(restBits)
+				rests = hashes & numpy.uint64((1 << restBits) - 1)
+				ranks = (restBits + 1 - _bit_length(rests, restBits)).astype(numpy.uint8)
+				view = numpy.frombuffer(registers, dtype=numpy.uint8)
+				numpy.maximum.at(view, indices, ranks)
+			else:
+				for h1, h2 in hashes:
+					index, rank = self._index_rank(h1)
+					if registers[index] < rank:
+						registers[index] = rank
+
+	def merge(self, hll):
+		"""Fold in another HyperLogLog so this estimates their union"""
+		if self._precision != hll._precision:
+			raise ValueError("Mismatched HyperLogLogs")
+		if numpy is not None:
+			view = numpy.frombuffer(self._registers, dtype=numpy.uint8)
+			other = numpy.frombuffer(hll._registers, dtype=numpy.uint8)
+			numpy.maximum(view, other, out=view)
+		else:
+			self._registers[:] = array.array(
+				'B', itertools.imap(max, self._registers, hll._registers)
+			)
+
+	def estimate(self):
+		numRegisters = len(self._registers)
+		alpha = 0.7213 / (1 + 1.079 / numRegisters)
+		harmonic = sum(2.0 ** -register for register in self._registers)
+		estimate = alpha * numRegisters * numRegisters / harmonic
+		if estimate <= 2.5 * numRegisters:
+			# Small range correction: linear counting over the empty registers
+			zeros = self._registers.count(0)
+			if zeros:
+				estimate = numRegisters * math.log(float(numRegisters) / zeros)
+		return estimate
+
+	def save(self, path):
+		"""
+		>>> import os, tempfile
+		>>> hll = HyperLogLog(precision=10)
+		>>> hll.add_many(xrange(1000))
+		>>> fd, path = tempfile.mkstemp()
+		>>> os.close(fd)
+		>>> hll.save(path)
+		>>> HyperLogLog.open(path)._registers == hll._registers
+		True
+		>>> os.remove(path)
+		"""
+		with open(path, "wb") as f:
+			f.write(self._HEADER.pack(
+				self._MAGIC, self._VERSION, BloomFilter.HASH_SCHEME, self._precision
+			))
+			self._registers.tofile(f)
+
+	@classmethod
+	def open(cls, path):
+		with open(path, "rb") as f:
+			precision, = _read_sketch_header(f, cls._HEADER, cls._MAGIC, cls._VERSION, path)
+			hll = cls(precision)
+			try:
+				hll._registers = array.array('B')
+				hll._registers.fromfile(f, 1 << precision)
+			except EOFError:
+				raise ValueError("Truncated registers in %s" % path)
+		return hll
+
+	def _index_rank(self, h1):
+		restBits = 64 - self._precision
+		rest = h1 & ((1 << restBits) - 1)
+		return h1 >> restBits, restBits + 1 - rest.bit_length()
+
+
+class CountMinSketch(object):
+	"""
+	Estimate per-key counts in width * depth counters.  Estimates never
+	undercount and overcount by at most e / width * total with probability
+	1 - exp(-depth).
+
+	Source: Cormode, Muthukrishnan "An Improved Data Stream Summary: The
+	Count-Min Sketch and its Applications"
+
+	>>> cms = CountMinSketch.from_error(epsilon=0.001, delta=0.01)
+	>>> cms.width, cms.depth
+	(2719, 5)
+	>>> for i in xrange(1000):
+	... 	cms.add(i % 10)
+	>>> cms.add("heavy", 500)
+	>>> cms.estimate(3), cms.estimate("heavy"), cms.estimate("missing")
+	(100, 500, 0)
+	>>> cms.total
+	1500
+	>>> bulk = CountMinSketch(width=2719, depth=5)
+	>>> bulk.add_many(i % 10 for i in xrange(1000))
+	>>> bulk.add("heavy", 500)
+	>>> bulk._counters == cms._counters
+	True
+	>>> bulk.estimate_many([3, "heavy", "missing"])
+	[100, 500, 0]
+	>>> cms.merge(bulk)
+	>>> cms.estimate("heavy"), cms.total
+	(1000, 3000)
+	"""
+
+	_HEADER = struct.Struct("<4sBBBxQIQ")
+	_MAGIC = "CMSK"
+	_VERSION = 1
+	_TYPECODE = 'l'
+
+	def __init__(self, width, depth):
+		self._width = width
+		self._depth = depth
+		self._counters = array.array(self._TYPECODE, [0]) * (width * depth)
+		self._total = 0
+
+	@classmethod
+	def from_error(cls, epsilon, delta):
+		"""Size a sketch to overcount by at most epsilon * total with probability 1 - delta"""
+		width = int(math.ceil(math.e / epsilon))
+		depth = int(math.ceil(math.log(1.0 / delta)))
+		return cls(width, depth)
+
+	@property
+	def width(self):
+		return self._width
+
+	@property
+	def depth(self):
+		return self._depth
+
+	@property
+	def total(self):
+		"""Sum of every count added"""
+		return self._total
+
+	def add(self, key, count = 1):
+		counters = self._counters
+		width = self._width
+		for row, position in enumerate(_probe_positions(key, self._depth, width)):
+			counters[row * width + position] += count
+		self._total += count
+
+	def add_many(self, keys):
+		"""
+		Count one occurrence of every key in the iterable, a batch at a time.
+		Key types are as for BloomFilter.
+		"""
+		counters = self._counters
+		width = self._width
+		depth = self._depth
+		for positions in _bulk_probe_positions(keys, depth, width):
+			if numpy is not None:
+				view = numpy.frombuffer(counters, dtype=self._numpy_dtype())
+				rows = self._row_offsets(len(positions) // depth)
+				numpy.add.at(view, positions + rows, 1)
+			else:
+				for i, position in enumerate(positions):
+					counters[(i % depth) * width + position] += 1
+			self._total += len(positions) // depth
+
+	def estimate(self, key):
+		counters = self._counters
+		width = self._width
+		return min(
+			counters[row * width + position]
+			for row, position in enumerate(_probe_positions(key, self._depth, width))
+		)
+
+	def estimate_many(self, keys):
+		"""
+		Estimated count of each key in the iterable, as a list.  Key types are
+		as for BloomFilter.
+		"""
+		counters = self._counters
+		width = self._width
+		depth = self._depth
+		results = []
+		for positions in _bulk_probe_positions(keys, depth, width):
+			if numpy is not None:
+				view = numpy.frombuffer(counters, dtype=self._numpy_dtype())
+				rows = self._row_offsets(len(positions) // depth)
+				results.extend(view[positions + rows].reshape(-1, depth).min(axis=1).tolist())
+			else:
+				for offset in xrange(0, len(positions), depth):
+					results.append(min(
+						counters[row * width + position]
+						for row, position in enumerate(positions[offset:offset+depth])
+					))
+		return results
+
+	def merge(self, cms):
+		"""Fold in another sketch so this estimates their combined counts"""
+		if self._width != cms._width or self._depth != cms._depth:
+			raise ValueError("Mismatched count-min sketches")
+		if numpy is not None:
+			view = numpy.frombuffer(self._counters, dtype=self._numpy_dtype())
+			view += numpy.frombuffer(cms._counters, dtype=self._numpy_dtype())
+		else:
+			self._counters[:] = array.array(
+				self._TYPECODE, itertools.imap(operator.add, self._counters, cms._counters)
+			)
+		self._total += cms._total
+
+	def save(self, path):
+		"""
+		>>> import os, tempfile
+		>>> cms = CountMinSketch(width=100, depth=4)
+		>>> cms.add_many(xrange(1000))
+		>>> fd, path = tempfile.mkstemp()
+		>>> os.close(fd)
+		>>> cms.save(path)
+		>>> loaded = CountMinSketch.open(path)
+		>>> loaded._counters == cms._counters, loaded.total
+		(True, 1000)
+		>>> os.remove(path)
+		"""
+		with open(path, "wb") as f:
+			f.write(self._HEADER.pack(
+				self._MAGIC, self._VERSION, BloomFilter.HASH_SCHEME,
+				self._counters.itemsize, self._width, self._depth, self._total,
+			))
+			self._counters.tofile(f)
+
+	@classmethod
+	def open(cls, path):
+		with open(path, "rb") as f:
+			itemsize, width, depth, total = _read_sketch_header(
+				f, cls._HEADER, cls._MAGIC, cls._VERSION, path
+			)
+			cms = cls(width, depth)
+			if itemsize != cms._counters.itemsize:
+				raise ValueError("%s has %d byte counters, expected %d" % (
+					path, itemsize, cms._counters.itemsize
+				))
+			try:
+				cms._counters = array.array(cls._TYPECODE)
+				cms._counters.fromfile(f, width * depth)
+			except EOFError:
+				raise ValueError("Truncated counters in %s" % path)
+			cms._total = total
+		return cms
+
+	def _row_offsets(self, numKeys):
+		"""Offset of each row's counters, repeated for numKeys keys"""
+		rowStarts = numpy.arange(self._depth, dtype=numpy.uint64) * numpy.uint64(self._width)
+		return numpy.tile(rowStarts, numKeys)
+
+	def _numpy_dtype(self):
+		return numpy.dtype("int%d" % (self._counters.itemsize * 8))
 
 
 if __name__ == "__main__":
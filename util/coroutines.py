@@ -18,14 +18,33 @@ Design considerations
 ** If so, make s* and co* implementation of functions
 """
 
+import sys
+import time
 import threading
+import multiprocessing
+import random
 import Queue
-import pickle
+import cPickle as pickle
+import struct
+import zlib
+import mmap as _mmap
 import functools
 import itertools
 import xml.sax
 import xml.parsers.expat
 
+import algorithms
+
+try:
+	import trollius as asyncio
+	from trollius import From
+except ImportError:
+	asyncio = None
+
+	def From(obj):
+		"""Stands in for trollius.From, which passes obj straight through"""
+		return obj
+
 
 def autostart(func):
 	"""
@@ -54,6 +73,54 @@ def autostart(func):
 	return start
 
 
+class Batch(list):
+	"""
+	Several items travelling through a pipeline as a single send.  Stages
+	marked batch_aware process a Batch in one tight loop and forward the
+	results downstream as one Batch.
+	"""
+
+
+_BATCH_AWARE_CODE = set()
+
+
+def batch_aware(func):
+	"""Mark a coroutine function whose coroutines accept Batch items"""
+	_BATCH_AWARE_CODE.add(func.func_code)
+	return func
+
+
+def accepts_batches(target):
+	return (
+		getattr(target, "gi_code", None) in _BATCH_AWARE_CODE or
+		getattr(target, "accepts_batches", False)
+	)
+
+
+def send_many(target, items):
+	"""
+	Send items to target, as one Batch if it accepts them or one at a time
+	if it doesn't
+
+	>>> l = []
+	>>> send_many(comap(lambda x: x * 2, append_sink(l)), [1, 2, 3])
+	>>> l
+	[2, 4, 6]
+	>>> send_many(comap(lambda x: x * 2, printer_sink()), [1, 2])
+	2
+	4
+	"""
+	if not items:
+		return
+	if accepts_batches(target):
+		if type(items) is not Batch:
+			items = Batch(items)
+		target.send(items)
+	else:
+		for item in items:
+			target.send(item)
+
+
 @autostart
 def printer_sink(format = "%s"):
 	"""
@@ -78,6 +145,31 @@ def printer_sink(format = "%s"):
 		print format % (item, )
 
 
+@autostart
+@batch_aware
+def error_sink(l):
+	"""
+	Collects items, and the names of exceptions thrown in, into l
+
+	>>> l = []
+	>>> es = error_sink(l)
+	>>> es.send(1)
+	>>> es.throw(RuntimeError, "Goodbye")
+	>>> es.send(Batch([2, 3]))
+	>>> l
+	[1, 'RuntimeError', 2, 3]
+	"""
+	while True:
+		try:
+			item = yield
+			if type(item) is Batch:
+				l.extend(item)
+			else:
+				l.append(item)
+		except StandardError, e:
+			l.append(e.__class__.__name__)
+
+
 @autostart
 def null_sink():
 	"""
@@ -87,17 +179,30 @@ def null_sink():
 		item = yield
 
 
-def itr_source(itr, target):
+def itr_source(itr, target, batch_size = None):
 	"""
 	>>> itr_source(xrange(2), printer_sink())
 	0
 	1
+	>>> l = []
+	>>> itr_source(xrange(5), append_sink(l), batch_size=2)
+	>>> l
+	[0, 1, 2, 3, 4]
 	"""
-	for item in itr:
-		target.send(item)
+	if batch_size is None:
+		for item in itr:
+			target.send(item)
+	else:
+		itr = iter(itr)
+		while True:
+			batch = Batch(itertools.islice(itr, batch_size))
+			if not batch:
+				break
+			send_many(target, batch)
 
 
 @autostart
+@batch_aware
 def cofilter(predicate, target):
 	"""
 	>>> p = printer_sink()
@@ -114,6 +219,17 @@ def cofilter(predicate, target):
 	>>> cf.send(0)
 	>>> cf.send(1)
 	1
+	>>> cf.send(Batch([0, 2, "", "a"]))
+	2
+	a
+
+	An item raising within a Batch doesn't lose the others
+
+	>>> l = []
+	>>> cf = cofilter(lambda x: 2 / x, error_sink(l))
+	>>> cf.send(Batch([1, 0, 2]))
+	>>> l
+	[1, 'ZeroDivisionError', 2]
 	>>> # cf.throw(RuntimeError, "Goodbye")
 	>>> # cf.send(False)
 	>>> # cf.send(True)
@@ -125,13 +241,25 @@ def cofilter(predicate, target):
 	while True:
 		try:
 			item = yield
-			if predicate(item):
+			if type(item) is Batch:
+				selected = Batch()
+				for value in item:
+					try:
+						if predicate(value):
+							selected.append(value)
+					except StandardError, e:
+						send_many(target, selected)
+						selected = Batch()
+						target.throw(e.__class__, e.message)
+				send_many(target, selected)
+			elif predicate(item):
 				target.send(item)
 		except StandardError, e:
 			target.throw(e.__class__, e.message)
 
 
 @autostart
+@batch_aware
 def comap(function, target):
 	"""
 	>>> p = printer_sink()
@@ -142,6 +270,17 @@ def comap(function, target):
 	2.0
 	>>> cm.send(-2)
 	-1
+	>>> cm.send(Batch([1, 2]))
+	2
+	3
+
+	An item raising within a Batch doesn't lose the others
+
+	>>> l = []
+	>>> cm = comap(lambda x: 10 / x, error_sink(l))
+	>>> cm.send(Batch([1, 0, 2]))
+	>>> l
+	[10, 'ZeroDivisionError', 5]
 	>>> # cm.throw(RuntimeError, "Goodbye")
 	>>> # cm.send(0)
 	>>> # cm.send(1.0)
@@ -150,8 +289,19 @@ def comap(function, target):
 	while True:
 		try:
 			item = yield
-			mappedItem = function(item)
-			target.send(mappedItem)
+			if type(item) is Batch:
+				mapped = Batch()
+				for value in item:
+					try:
+						mapped.append(function(value))
+					except StandardError, e:
+						send_many(target, mapped)
+						mapped = Batch()
+						target.throw(e.__class__, e.message)
+				send_many(target, mapped)
+			else:
+				mappedItem = function(item)
+				target.send(mappedItem)
 		except StandardError, e:
 			target.throw(e.__class__, e.message)
 
@@ -170,6 +320,7 @@ def expand_positional(function):
 
 
 @autostart
+@batch_aware
 def append_sink(l):
 	"""
 	>>> l = []
@@ -177,12 +328,16 @@ def append_sink(l):
 	>>> apps.send(1)
 	>>> apps.send(2)
 	>>> apps.send(3)
+	>>> apps.send(Batch([4, 5]))
 	>>> print l
-	[1, 2, 3]
+	[1, 2, 3, 4, 5]
 	"""
 	while True:
 		item = yield
-		l.append(item)
+		if type(item) is Batch:
+			l.extend(item)
+		else:
+			l.append(item)
 
 
 @autostart
@@ -236,6 +391,45 @@ def coreduce(target, function, initializer = None):
 
 
 @autostart
+def cosample(target, k, rng = None):
+	"""
+	Keep a uniform random sample of k of the items received, sending the
+	sample to target as a list when closed (see algorithms.reservoir_sample)
+
+	>>> cs = cosample(printer_sink("%r"), 3)
+	>>> cs.send("a")
+	>>> cs.send("b")
+	>>> cs.close()
+	['a', 'b']
+	>>> sample = []
+	>>> cs = cosample(append_sink(sample), 3)
+	>>> for i in xrange(1000):
+	... 	cs.send(i)
+	>>> cs.close()
+	>>> len(sample[0]), len(set(sample[0]))
+	(3, 3)
+	"""
+	if rng is None:
+		rng = random
+	reservoir = []
+	try:
+		while len(reservoir) < k:
+			item = yield
+			reservoir.append(item)
+		if 0 < k:
+			for skip in algorithms.reservoir_skips(k, rng):
+				for i in xrange(skip + 1):
+					item = yield
+				reservoir[rng.randrange(k)] = item
+		while True:
+			item = yield
+	except GeneratorExit:
+		target.send(reservoir)
+		raise
+
+
+@autostart
+@batch_aware
 def cotee(targets):
 	"""
 	Takes a sequence of coroutines and sends the received items to all of them
@@ -247,6 +441,13 @@ def cotee(targets):
 	>>> ct.send("World")
 	1 World
 	2 World
+	>>> l = []
+	>>> ct = cotee((printer_sink("1 %s"), append_sink(l)))
+	>>> ct.send(Batch(["a", "b"]))
+	1 a
+	1 b
+	>>> l
+	['a', 'b']
 	>>> # ct.throw(RuntimeError, "Goodbye")
 	>>> # ct.send("Meh")
 	>>> # ct.close()
@@ -254,8 +455,12 @@ def cotee(targets):
 	while True:
 		try:
 			item = yield
-			for target in targets:
-				target.send(item)
+			if type(item) is Batch:
+				for target in targets:
+					send_many(target, item)
+			else:
+				for target in targets:
+					target.send(item)
 		except StandardError, e:
 			for target in targets:
 				target.throw(e.__class__, e.message)
@@ -277,6 +482,10 @@ class CoTee(object):
 	1 Foo
 	2 Foo
 	3 Foo
+	>>> ct.stage.send(Batch(["Bar"]))
+	1 Bar
+	2 Bar
+	3 Bar
 	>>> # ct.stage.throw(RuntimeError, "Goodbye")
 	>>> # ct.stage.send("Meh")
 	>>> # ct.stage.close()
@@ -296,12 +505,17 @@ class CoTee(object):
 		self.stage = self._stage()
 
 	@autostart
+	@batch_aware
 	def _stage(self):
 		while True:
 			try:
 				item = yield
-				for target in self._targets:
-					target.send(item)
+				if type(item) is Batch:
+					for target in self._targets:
+						send_many(target, item)
+				else:
+					for target in self._targets:
+						target.send(item)
 			except StandardError, e:
 				for target in self._targets:
 					target.throw(e.__class__, e.message)
@@ -331,6 +545,7 @@ def cocount(target, start = 0):
 
 
 @autostart
+@batch_aware
 def coenumerate(target, start = 0):
 	"""
 	>>> ce = coenumerate(printer_sink("%r"))
@@ -342,11 +557,23 @@ def coenumerate(target, start = 0):
 	(2, [])
 	>>> ce.send(0)
 	(3, 0)
+	>>> ce.send(Batch([1, "b"]))
+	(4, 1)
+	(5, 'b')
+	>>> ce.send("c")
+	(6, 'c')
 	"""
-	for i in itertools.count(start):
+	i = start
+	while True:
 		item = yield
-		decoratedItem = i, item
-		target.send(decoratedItem)
+		if type(item) is Batch:
+			decoratedItems = Batch(itertools.izip(itertools.count(i), item))
+			i += len(item)
+			send_many(target, decoratedItems)
+		else:
+			decoratedItem = i, item
+			i += 1
+			target.send(decoratedItem)
 
 
 @autostart
@@ -444,6 +671,7 @@ def cotakewhile(target, pred):
 
 
 @autostart
+@batch_aware
 def coslice(target, lower, upper):
 	"""
 	>>> cs = coslice(printer_sink("%r"), 3, 5)
@@ -456,14 +684,23 @@ def coslice(target, lower, upper):
 	'4'
 	>>> cs.send("5")
 	>>> cs.send("6")
+	>>> cs = coslice(printer_sink("%r"), 3, 5)
+	>>> cs.send(Batch(["0", "1", "2", "3"]))
+	'3'
+	>>> cs.send(Batch(["4", "5"]))
+	'4'
 	"""
-	for i in xrange(lower):
-		item = yield
-	for i in xrange(upper - lower):
-		item = yield
-		target.send(item)
+	i = 0
 	while True:
 		item = yield
+		if type(item) is Batch:
+			selected = item[max(lower - i, 0):max(upper - i, 0)]
+			i += len(item)
+			send_many(target, selected)
+		else:
+			if lower <= i < upper:
+				target.send(item)
+			i += 1
 
 
 @autostart
@@ -496,17 +733,21 @@ def cochain(targets):
 
 
 @autostart
+@batch_aware
 def queue_sink(queue):
 	"""
+	Batches are put on the queue whole, as one entry
+
 	>>> q = Queue.Queue()
 	>>> qs = queue_sink(q)
 	>>> qs.send("Hello")
 	>>> qs.send("World")
 	>>> qs.throw(RuntimeError, "Goodbye")
 	>>> qs.send("Meh")
+	>>> qs.send(Batch(["Foo", "Bar"]))
 	>>> qs.close()
 	>>> print [i for i in _flush_queue(q)]
-	[(None, 'Hello'), (None, 'World'), (<type 'exceptions.RuntimeError'>, 'Goodbye'), (None, 'Meh'), (<type 'exceptions.GeneratorExit'>, None)]
+	[(None, 'Hello'), (None, 'World'), (<type 'exceptions.RuntimeError'>, 'Goodbye'), (None, 'Meh'), (None, ['Foo', 'Bar']), (<type 'exceptions.GeneratorExit'>, None)]
 	"""
 	while True:
 		try:
@@ -521,7 +762,10 @@ def queue_sink(queue):
 
 def decode_item(item, target):
 	if item[0] is None:
-		target.send(item[1])
+		if type(item[1]) is Batch:
+			send_many(target, item[1])
+		else:
+			target.send(item[1])
 		return False
 	elif item[0] is GeneratorExit:
 		target.close()
@@ -550,14 +794,602 @@ def queue_source(queue, target):
 		isDone = decode_item(item, target)
 
 
-def threaded_stage(target, thread_factory = threading.Thread):
-	messages = Queue.Queue()
+class _PendingBatch(object):
+	"""
+	The items a batch_queue_sink is holding back.  With a linger a flusher
+	thread ships them once it expires, so an idle stream isn't left waiting.
+	"""
+
+	def __init__(self, queue, batchSize, linger):
+		self._queue = queue
+		self._batchSize = batchSize
+		self._linger = linger
+		self._cond = threading.Condition()
+		self._items = Batch()
+		self._deadline = None
+		self._isClosed = False
+		if linger is not None:
+			flusher = threading.Thread(target=self._flush_expired)
+			flusher.daemon = True
+			flusher.start()
+
+	def add(self, item):
+		with self._cond:
+			wasEmpty = not self._items
+			if type(item) is Batch:
+				self._items.extend(item)
+			else:
+				self._items.append(item)
+			if self._batchSize is not None and self._batchSize <= len(self._items):
+				self._flush()
+			elif wasEmpty and self._linger is not None:
+				self._deadline = time.time() + self._linger
+				self._cond.notify()
+
+	def put(self, entry):
+		"""Put entry on the queue after whatever is pending"""
+		with self._cond:
+			self._flush()
+			self._queue.put(entry)
+
+	def close(self):
+		with self._cond:
+			self._isClosed = True
+			self._cond.notify()
+
+	def _flush(self):
+		if self._items:
+			self._queue.put((None, self._items))
+			self._items = Batch()
+			self._deadline = None
+
+	def _flush_expired(self):
+		with self._cond:
+			while not self._isClosed:
+				if not self._items:
+					self._cond.wait()
+					continue
+				remaining = self._deadline - time.time()
+				if 0 < remaining:
+					self._cond.wait(remaining)
+				else:
+					self._flush()
+
+
+@autostart
+@batch_aware
+def batch_queue_sink(queue, batch_size = None, linger_ms = None):
+	"""
+	Like queue_sink but ships items as one Batch per queue entry, once
+	batch_size items are pending or linger_ms has passed since the first of
+	them, whether or not more items arrive.
+
+	>>> q = Queue.Queue()
+	>>> qs = batch_queue_sink(q, batch_size=2)
+	>>> for i in xrange(3):
+	... 	qs.send(i)
+	>>> qs.throw(RuntimeError, "Goodbye")
+	>>> qs.send(3)
+	>>> qs.close()
+	>>> print [i for i in _flush_queue(q)]
+	[(None, [0, 1]), (None, [2]), (<type 'exceptions.RuntimeError'>, 'Goodbye'), (None, [3]), (<type 'exceptions.GeneratorExit'>, None)]
+	>>> qs = batch_queue_sink(q, batch_size=100, linger_ms=10)
+	>>> qs.send(Batch([4, 5]))
+	>>> q.get(timeout=5)
+	(None, [4, 5])
+	>>> qs.close()
+	"""
+	if linger_ms is None:
+		linger = None
+	else:
+		linger = linger_ms / 1000.0
+	pending = _PendingBatch(queue, batch_size, linger)
+	try:
+		while True:
+			try:
+				item = yield
+				pending.add(item)
+			except StandardError, e:
+				pending.put((e.__class__, e.message))
+	except GeneratorExit:
+		pending.close()
+		pending.put((GeneratorExit, None))
+		raise
+
+
+class ThreadedStage(object):
+	"""
+	Runs target in a worker thread, fed through a queue by the sinks this
+	returns when called.  Closing a sink shuts the worker down; join() waits
+	for it and re-raises anything that escaped target.
+
+	>>> l = []
+	>>> stage = ThreadedStage(append_sink(l), maxsize=2, batch_size=3)
+	>>> sink = stage()
+	>>> for i in xrange(10):
+	... 	sink.send(i)
+	>>> sink.close()
+	>>> stage.join()
+	>>> l
+	[0, 1, 2, 3, 4, 5, 6, 7, 8, 9]
+	>>> stage.thread.is_alive()
+	False
+	>>> stage = ThreadedStage(comap(lambda x: 1 / x, append_sink([])), maxsize=1)
+	>>> sink = stage()
+	>>> for i in xrange(5):
+	... 	sink.send(i)
+	>>> sink.close()
+	>>> stage.join()
+	Traceback (most recent call last):
+	...
+	ZeroDivisionError: integer division or modulo by zero
+	>>> @autostart
+	... def fails_on_close():
+	... 	try:
+	... 		while True:
+	... 			(yield)
+	... 	except GeneratorExit:
+	... 		raise ValueError('close failed')
+	>>> stage = ThreadedStage(fails_on_close())
+	>>> sink = stage()
+	>>> sink.send(1)
+	>>> sink.close()
+	>>> stage.join()
+	Traceback (most recent call last):
+	...
+	ValueError: close failed
+	>>> stage.thread.is_alive()
+	False
+	"""
+
+	def __init__(self, target, thread_factory = threading.Thread, maxsize = 0, batch_size = None, linger_ms = None):
+		self.queue = Queue.Queue(maxsize)
+		self.error = None
+		self._target = target
+		self._batchSize = batch_size
+		self._lingerMs = linger_ms
+		self.thread = thread_factory(target=self._run)
+		self.thread.start()
+
+	def __call__(self):
+		"""Create a sink, running in the current thread, feeding the worker"""
+		if self._batchSize is None and self._lingerMs is None:
+			return queue_sink(self.queue)
+		else:
+			return batch_queue_sink(self.queue, self._batchSize, self._lingerMs)
+
+	def _run(self):
+		item = (None, None)
+		try:
+			isDone = False
+			while not isDone:
+				item = self.queue.get()
+				isDone = decode_item(item, self._target)
+		except Exception:
+			self.error = sys.exc_info()
+			# Keep consuming so producers blocked on a full queue can finish
+			# and close their sink, unless target raised while being closed
+			isDone = item[0] is GeneratorExit
+			while not isDone:
+				isDone = self.queue.get()[0] is GeneratorExit
+
+	def join(self, timeout = None):
+		self.thread.join(timeout)
+		if self.error is not None and not self.thread.is_alive():
+			error, self.error = self.error, None
+			raise error[0], error[1], error[2]
+
+	def close(self, timeout = None):
+		"""Shut the worker down without going through a sink"""
+		if self.thread.is_alive():
+			self.queue.put((GeneratorExit, None))
+		self.join(timeout)
+
+
+def threaded_stage(target, thread_factory = threading.Thread, maxsize = 0, batch_size = None, linger_ms = None):
+	"""
+	maxsize bounds the queue, blocking fast producers; batch_size and
+	linger_ms make the sink ship Batches instead of single items.  The
+	returned ThreadedStage is called to create the sink and keeps the
+	worker thread for join().
+
+	>>> l = []
+	>>> stage = threaded_stage(append_sink(l), maxsize=4, batch_size=2)
+	>>> sink = stage()
+	>>> sink.send("Hello")
+	>>> sink.send("World")
+	>>> sink.close()
+	>>> stage.join()
+	>>> l
+	['Hello', 'World']
+	"""
+	return ThreadedStage(target, thread_factory, maxsize, batch_size, linger_ms)
+
+
+class _ListQueue(list):
+	"""Lets queue_sink collect into a plain list"""
+
+	put = list.append
+
+
+# How long process_stage waits on its workers before checking they are alive
+_PROCESS_POLL_INTERVAL = 0.1
+
+
+def _process_stage_worker(index, target_factory, inQueue, outQueue):
+	# Messages are pickled here rather than by the queue's feeder thread so
+	# anything unpicklable fails where it can still be reported
+	try:
+		collected = _ListQueue()
+		pipeline = target_factory(queue_sink(collected))
+		while True:
+			chunk = inQueue.get()
+			if chunk is None:
+				break
+			results = []
+			for seq, item in chunk:
+				try:
+					pipeline.send(item)
+				except StandardError, e:
+					collected.put((e.__class__, e.message))
+				results.append((seq, collected[:]))
+				del collected[:]
+			outQueue.put(pickle.dumps((index, results, None, None), pickle.HIGHEST_PROTOCOL))
+
+		try:
+			pipeline.close()
+		except StandardError, e:
+			collected.put((e.__class__, e.message))
+		tail = [event for event in collected if event[0] is not GeneratorExit]
+		outQueue.put(pickle.dumps((index, None, tail, None), pickle.HIGHEST_PROTOCOL))
+	except Exception, e:
+		if isinstance(e, StopIteration):
+			# Raising that in the parent would just end the stage quietly
+			e = RuntimeError("process_stage worker %d's pipeline stopped" % index)
+		try:
+			message = pickle.dumps((index, None, None, e), pickle.HIGHEST_PROTOCOL)
+		except Exception:
+			error = RuntimeError("%s: %s" % (e.__class__.__name__, e))
+			message = pickle.dumps((index, None, None, error), pickle.HIGHEST_PROTOCOL)
+		outQueue.put(message)
+
+
+@autostart
+@batch_aware
+def process_stage(target_factory, target, workers = None, shard_key = None, ordered = False, chunk_size = 64, maxsize = 4):
+	"""
+	Fans items out over worker processes, each running the sub-pipeline
+	built by target_factory(sink), and sends what they produce on to target.
+
+	Items go to a worker by hash of shard_key(item), or round-robin without
+	a shard_key, in chunks of chunk_size with up to maxsize chunks queued per
+	worker.  With ordered the outputs are restored to input order, otherwise
+	they are sent as they arrive.  Whatever the sub-pipelines emit when
+	closed follows the rest, and exceptions thrown into the stage go
+	straight to target.  target_factory is handed to multiprocessing, so
+	it has to be picklable where processes are not forked.
+
+	>>> l = []
+	>>> ps = process_stage(
+	... 	lambda sink: comap(lambda x: x * x, cofilter(lambda x: x % 3, sink)),
+	... 	append_sink(l), workers=3, ordered=True, chunk_size=2,
+	... )
+	>>> itr_source(xrange(10), ps)
+	>>> ps.close()
+	>>> l
+	[1, 4, 16, 25, 49, 64]
+	>>> l = []
+	>>> ps = process_stage(
+	... 	lambda sink: coenumerate(sink), append_sink(l),
+	... 	workers=2, shard_key=lambda x: x % 2,
+	... )
+	>>> send_many(ps, range(6))
+	>>> ps.close()
+	>>> sorted(l)
+	[(0, 0), (0, 1), (1, 2), (1, 3), (2, 4), (2, 5)]
+
+	A worker failing, or dying outright, is raised rather than waited on
+
+	>>> def broken(sink):
+	... 	raise ValueError("No pipeline")
+	>>> ps = process_stage(broken, append_sink([]), workers=2)
+	>>> itr_source(xrange(10), ps)
+	>>> ps.close()
+	Traceback (most recent call last):
+	ValueError: No pipeline
+	>>> import os
+	>>> ps = process_stage(lambda sink: comap(os._exit, sink), append_sink([]), workers=1, chunk_size=1)
+	>>> ps.send(3)
+	>>> ps.close()
+	Traceback (most recent call last):
+	RuntimeError: process_stage worker 0 exited with code 3
+	>>> @autostart
+	... def first_only(sink):
+	... 	sink.send((yield))
+	>>> ps = process_stage(first_only, append_sink([]), workers=1, chunk_size=1)
+	>>> ps.send("a")
+	>>> ps.close()
+	Traceback (most recent call last):
+	RuntimeError: process_stage worker 0's pipeline stopped
+	"""
+	if workers is None:
+		workers = multiprocessing.cpu_count()
+	outQueue = multiprocessing.Queue()
+	inQueues = [multiprocessing.Queue(maxsize) for i in xrange(workers)]
+	processes = [
+		multiprocessing.Process(
+			target=_process_stage_worker,
+			args=(worker, target_factory, inQueue, outQueue),
+		)
+		for worker, inQueue in enumerate(inQueues)
+	]
+	for process in processes:
+		process.daemon = True
+		process.start()
+
+	chunks = [[] for i in xrange(workers)]
+	roundRobin = itertools.cycle(xrange(workers))
+	pending = {}
+	nextSeq = [0]
+	finished = set()
+	tails = []
+
+	def deliver(results):
+		for seq, events in results:
+			if ordered:
+				pending[seq] = events
+			else:
+				for event in events:
+					decode_item(event, target)
+		while nextSeq[0] in pending:
+			for event in pending.pop(nextSeq[0]):
+				decode_item(event, target)
+			nextSeq[0] += 1
+
+	def handle(message):
+		worker, results, tail, error = pickle.loads(message)
+		if error is not None:
+			raise error
+		if results is None:
+			tails.extend(tail)
+			finished.add(worker)
+		else:
+			deliver(results)
+
+	def collect():
+		while True:
+			try:
+				message = outQueue.get_nowait()
+			except Queue.Empty:
+				return
+			handle(message)
+
+	def check_alive(worker):
+		process = processes[worker]
+		if worker not in finished and not process.is_alive():
+			# Anything it sent before dying is readable by now
+			collect()
+			if worker in finished:
+				return
+			raise RuntimeError("process_stage worker %d exited with code %s" % (
+				worker, process.exitcode
+			))
+
+	def ship(worker, chunk):
+		while True:
+			try:
+				inQueues[worker].put(chunk, timeout=_PROCESS_POLL_INTERVAL)
+				return
+			except Queue.Full:
+				collect()
+				check_alive(worker)
+
+	seq = 0
+	isClean = False
+	try:
+		while True:
+			try:
+				item = yield
+			except StandardError, e:
+				target.throw(e.__class__, e.message)
+				continue
+			if type(item) is Batch:
+				items = item
+			else:
+				items = (item, )
+			isShipped = False
+			for item in items:
+				try:
+					if shard_key is None:
+						worker = roundRobin.next()
+					else:
+						worker = hash(shard_key(item)) % workers
+				except StandardError, e:
+					target.throw(e.__class__, e.message)
+					continue
+				chunk = chunks[worker]
+				chunk.append((seq, item))
+				seq += 1
+				if chunk_size <= len(chunk):
+					ship(worker, chunk)
+					chunks[worker] = []
+					isShipped = True
+			if isShipped:
+				collect()
+	except GeneratorExit:
+		for worker, chunk in enumerate(chunks):
+			if chunk:
+				ship(worker, chunk)
+			ship(worker, None)
+		while len(finished) < workers:
+			try:
+				message = outQueue.get(timeout=_PROCESS_POLL_INTERVAL)
+			except Queue.Empty:
+				for worker in xrange(workers):
+					check_alive(worker)
+				continue
+			handle(message)
+		for process in processes:
+			process.join()
+		isClean = True
+		for event in tails:
+			decode_item(event, target)
+		target.close()
+		raise
+	finally:
+		if not isClean:
+			for process in processes:
+				if process.is_alive():
+					process.terminate()
+			for inQueue in inQueues:
+				inQueue.cancel_join_thread()
+
+try:
+	StopAsyncIteration = StopAsyncIteration
+except NameError:
+	class StopAsyncIteration(Exception):
+		"""Ends an async iterator's __anext__"""
+
+
+def async_source(aiter, target):
+	"""
+	Returns an asyncio coroutine feeding target from aiter, which either has
+	an __anext__ returning awaitables (ending with StopAsyncIteration) or
+	is an iterator of futures/coroutines.  Needs trollius, the asyncio port.
+
+	>>> l = []
+	>>> loop = asyncio.new_event_loop() #doctest: +SKIP
+	>>> futures = [asyncio.sleep(0, i, loop=loop) for i in xrange(3)] #doctest: +SKIP
+	>>> loop.run_until_complete(async_source(iter(futures), append_sink(l))) #doctest: +SKIP
+	>>> loop.close() #doctest: +SKIP
+	>>> l #doctest: +SKIP
+	[0, 1, 2]
+
+	The coroutine itself can be stepped without a loop, resolving whatever
+	it waits on to itself:
+
+	>>> def drive(coro):
+	... 	try:
+	... 		result = coro.next()
+	... 		while True:
+	... 			result = coro.send(result)
+	... 	except StopIteration:
+	... 		pass
+	>>> l = []
+	>>> drive(_async_source(iter(xrange(3)), append_sink(l)))
+	>>> l
+	[0, 1, 2]
+	>>> class Countdown(object):
+	... 	def __init__(self, n):
+	... 		self.n = n
+	... 	def __anext__(self):
+	... 		if not self.n:
+	... 			raise StopAsyncIteration
+	... 		self.n -= 1
+	... 		return self.n
+	>>> l = []
+	>>> drive(_async_source(Countdown(3), append_sink(l)))
+	>>> l
+	[2, 1, 0]
+	"""
+	if asyncio is None:
+		raise RuntimeError("async_source requires trollius")
+	return asyncio.coroutine(_async_source)(aiter, target)
+
+
+def _async_source(aiter, target):
+	anext = getattr(aiter, "__anext__", None)
+	if anext is None:
+		anext = aiter.next
+	while True:
+		try:
+			item = yield From(anext())
+		except (StopAsyncIteration, StopIteration):
+			break
+		target.send(item)
+	target.close()
+
+
+class _LoopQueue(object):
+	"""Puts onto an asyncio.Queue from another thread"""
+
+	def __init__(self, queue, loop):
+		self._queue = queue
+		self._loop = loop
+
+	def put(self, item):
+		self._loop.call_soon_threadsafe(self._queue.put_nowait, item)
+
+
+def async_queue_sink(queue, loop, batch_size = 64, linger_ms = 10):
+	"""
+	A sink for a non-loop thread, such as the end of a threaded_stage, handing
+	Batches to an unbounded asyncio.Queue with one call_soon_threadsafe each,
+	encoded as by batch_queue_sink.  async_queue_source decodes them on the
+	loop.  Only loop and queue are touched, so this works without trollius.
+
+	>>> class ImmediateLoop(object):
+	... 	def call_soon_threadsafe(self, callback, *args):
+	... 		callback(*args)
+	>>> q = Queue.Queue()
+	>>> qs = async_queue_sink(q, ImmediateLoop(), batch_size=2)
+	>>> itr_source(xrange(3), qs)
+	>>> qs.close()
+	>>> print [i for i in _flush_queue(q)]
+	[(None, [0, 1]), (None, [2]), (<type 'exceptions.GeneratorExit'>, None)]
+	"""
+	return batch_queue_sink(_LoopQueue(queue, loop), batch_size, linger_ms)
+
 
-	run_source = functools.partial(queue_source, messages, target)
-	thread_factory(target=run_source).start()
+def async_queue_source(queue, target):
+	"""
+	Returns an asyncio coroutine feeding target from what an async_queue_sink
+	puts on queue, until that sink is closed.  Needs trollius.
 
-	# Sink running in current thread
-	return functools.partial(queue_sink, messages)
+	>>> l = []
+	>>> loop = asyncio.new_event_loop() #doctest: +SKIP
+	>>> q = asyncio.Queue(loop=loop) #doctest: +SKIP
+	>>> stage = threaded_stage(async_queue_sink(q, loop, batch_size=4)) #doctest: +SKIP
+	>>> sink = stage() #doctest: +SKIP
+	>>> itr_source(xrange(10), sink) #doctest: +SKIP
+	>>> sink.close() #doctest: +SKIP
+	>>> stage.join() #doctest: +SKIP
+	>>> loop.run_until_complete(async_queue_source(q, append_sink(l))) #doctest: +SKIP
+	>>> loop.close() #doctest: +SKIP
+	>>> l #doctest: +SKIP
+	[0, 1, 2, 3, 4, 5, 6, 7, 8, 9]
+
+	Without a loop, the coroutine can be stepped over a plain Queue filled by
+	async_queue_sink, resolving each get() to the item taken:
+
+	>>> class ImmediateLoop(object):
+	... 	def call_soon_threadsafe(self, callback, *args):
+	... 		callback(*args)
+	>>> q = Queue.Queue()
+	>>> qs = async_queue_sink(q, ImmediateLoop(), batch_size=4)
+	>>> itr_source(xrange(10), qs)
+	>>> qs.close()
+	>>> l = []
+	>>> coro = _async_queue_source(q, append_sink(l))
+	>>> try:
+	... 	item = coro.next()
+	... 	while True:
+	... 		item = coro.send(item)
+	... except StopIteration:
+	... 	pass
+	>>> l
+	[0, 1, 2, 3, 4, 5, 6, 7, 8, 9]
+	"""
+	if asyncio is None:
+		raise RuntimeError("async_queue_source requires trollius")
+	return asyncio.coroutine(_async_queue_source)(queue, target)
+
+
+def _async_queue_source(queue, target):
+	isDone = False
+	while not isDone:
+		item = yield From(queue.get())
+		isDone = decode_item(item, target)
 
 
 @autostart
@@ -586,6 +1418,219 @@ def pickle_source(f, target):
 		target.close()
 
 
+# Record files: a header, then frames each holding a pickled list of records,
+# then an index frame of frame offsets and a trailer pointing at it
+_RECORD_MAGIC = "CORF"
+_RECORD_VERSION = 1
+_RECORD_HEADER = struct.Struct("<4sB3x")
+_FRAME_HEADER = struct.Struct("<B3xII")
+_RECORD_TRAILER = struct.Struct("<Q4s")
+_INDEX_MAGIC = "CORX"
+_FRAME_ZLIB = 1
+_FRAME_CONTROL = 2
+_FRAME_INDEX = 4
+_RECORD_BUFFER_SIZE = 1 << 20
+
+
+@autostart
+@batch_aware
+def record_sink(f, frame_size = 4096, compress_level = None):
+	"""
+	Writes items to a record file, frame_size records to a frame pickled in
+	one go with the highest protocol and zlib compressed when compress_level
+	is given.  Exceptions and closing get frames of their own, and closing
+	also writes the frame index.  f is a binary file, or a path which is
+	then opened with a large write buffer and closed with the sink.
+
+	>>> import os, tempfile
+	>>> fd, path = tempfile.mkstemp()
+	>>> os.close(fd)
+	>>> rs = record_sink(path, frame_size=3, compress_level=1)
+	>>> itr_source(xrange(5), rs)
+	>>> send_many(rs, range(5, 10))
+	>>> rs.close()
+	>>> l = []
+	>>> record_source(path, append_sink(l))
+	>>> l
+	[0, 1, 2, 3, 4, 5, 6, 7, 8, 9]
+	>>> os.remove(path)
+	"""
+	ownsFile = isinstance(f, basestring)
+	if ownsFile:
+		f = open(f, "wb", _RECORD_BUFFER_SIZE)
+	offsets = []
+
+	def write_frame(flags, count, obj):
+		payload = pickle.dumps(obj, pickle.HIGHEST_PROTOCOL)
+		if compress_level is not None:
+			payload = zlib.compress(payload, compress_level)
+			flags |= _FRAME_ZLIB
+		offsets.append(f.tell())
+		f.write(_FRAME_HEADER.pack(flags, count, len(payload)))
+		f.write(payload)
+
+	f.write(_RECORD_HEADER.pack(_RECORD_MAGIC, _RECORD_VERSION))
+	pending = []
+	try:
+		while True:
+			try:
+				item = yield
+				if type(item) is Batch:
+					pending.extend(item)
+				else:
+					pending.append(item)
+				if frame_size <= len(pending):
+					write_frame(0, len(pending), pending)
+					pending = []
+			except StandardError, e:
+				if pending:
+					write_frame(0, len(pending), pending)
+					pending = []
+				write_frame(_FRAME_CONTROL, 0, (e.__class__, e.message))
+	except GeneratorExit:
+		if pending:
+			write_frame(0, len(pending), pending)
+		write_frame(_FRAME_CONTROL, 0, (GeneratorExit, None))
+		indexOffset = f.tell()
+		f.write(_FRAME_HEADER.pack(_FRAME_INDEX, len(offsets), 8 * len(offsets)))
+		f.write(struct.pack("<%dQ" % len(offsets), *offsets))
+		f.write(_RECORD_TRAILER.pack(indexOffset, _INDEX_MAGIC))
+		if ownsFile:
+			f.close()
+		else:
+			f.flush()
+		raise
+
+
+class RecordReader(object):
+	"""
+	Random access to the frames of a file written by record_sink.  With mmap
+	the file is mapped read-only rather than read into memory.  Files whose
+	writer never got to close them are scanned for their complete frames.
+
+	>>> import os, tempfile
+	>>> fd, path = tempfile.mkstemp()
+	>>> os.close(fd)
+	>>> rs = record_sink(path, frame_size=4)
+	>>> itr_source(xrange(10), rs)
+	>>> rs.close()
+	>>> reader = RecordReader(path)
+	>>> len(reader), reader.num_records
+	(4, 10)
+	>>> reader.frame(1)
+	(None, [4, 5, 6, 7])
+	>>> reader.frame(3)
+	(<type 'exceptions.GeneratorExit'>, None)
+	>>> reader.replay(printer_sink(), start=2)
+	8
+	9
+	>>> reader.close()
+	>>> f = open(path, "wb")
+	>>> rs = record_sink(f, frame_size=4)
+	>>> itr_source(xrange(10), rs)
+	>>> f.flush()
+	>>> reader = RecordReader(path, mmap=False)
+	>>> len(reader), reader.num_records
+	(2, 8)
+	>>> reader.close()
+	>>> rs.close()
+	>>> f.close()
+	>>> os.remove(path)
+	"""
+
+	def __init__(self, path, mmap = True):
+		with open(path, "rb") as f:
+			header = f.read(_RECORD_HEADER.size)
+			if len(header) != _RECORD_HEADER.size:
+				raise ValueError("Truncated record file header in %s" % path)
+			magic, version = _RECORD_HEADER.unpack(header)
+			if magic != _RECORD_MAGIC or version != _RECORD_VERSION:
+				raise ValueError("%s is not a record file" % path)
+			if mmap:
+				self._data = _mmap.mmap(f.fileno(), 0, access=_mmap.ACCESS_READ)
+			else:
+				f.seek(0)
+				self._data = f.read()
+		self._offsets = self._read_index()
+		if self._offsets is None:
+			self._offsets = self._scan()
+
+	def _read_index(self):
+		data = self._data
+		end = len(data) - _RECORD_TRAILER.size
+		if end < _RECORD_HEADER.size:
+			return None
+		indexOffset, magic = _RECORD_TRAILER.unpack_from(data, end)
+		if magic != _INDEX_MAGIC or end < indexOffset + _FRAME_HEADER.size:
+			return None
+		flags, count, length = _FRAME_HEADER.unpack_from(data, indexOffset)
+		if not flags & _FRAME_INDEX:
+			return None
+		return list(struct.unpack_from("<%dQ" % count, data, indexOffset + _FRAME_HEADER.size))
+
+	def _scan(self):
+		data = self._data
+		offsets = []
+		offset = _RECORD_HEADER.size
+		while offset + _FRAME_HEADER.size <= len(data):
+			flags, count, length = _FRAME_HEADER.unpack_from(data, offset)
+			end = offset + _FRAME_HEADER.size + length
+			if flags & _FRAME_INDEX or len(data) < end:
+				break
+			offsets.append(offset)
+			offset = end
+		return offsets
+
+	def __len__(self):
+		return len(self._offsets)
+
+	@property
+	def num_records(self):
+		return sum(
+			_FRAME_HEADER.unpack_from(self._data, offset)[1]
+			for offset in self._offsets
+		)
+
+	def frame(self, index):
+		"""
+		The frame encoded as queue_sink does: (None, Batch) for records, the
+		exception class and message, or GeneratorExit
+		"""
+		offset = self._offsets[index]
+		flags, count, length = _FRAME_HEADER.unpack_from(self._data, offset)
+		start = offset + _FRAME_HEADER.size
+		payload = self._data[start:start + length]
+		if flags & _FRAME_ZLIB:
+			payload = zlib.decompress(payload)
+		obj = pickle.loads(payload)
+		if flags & _FRAME_CONTROL:
+			return obj
+		return None, Batch(obj)
+
+	def replay(self, target, start = 0):
+		"""
+		Send the frames from start on to target, closing it at the end even
+		if the writer never did
+		"""
+		for index in xrange(start, len(self._offsets)):
+			if decode_item(self.frame(index), target):
+				return
+		target.close()
+
+	def close(self):
+		if isinstance(self._data, _mmap.mmap):
+			self._data.close()
+		self._data = None
+
+
+def record_source(path, target, mmap = True):
+	reader = RecordReader(path, mmap)
+	try:
+		reader.replay(target)
+	finally:
+		reader.close()
+
+
 class EventHandler(object, xml.sax.ContentHandler):
 
 	START = "start"
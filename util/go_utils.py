@@ -153,13 +153,11 @@ class FutureThread(object):
 
 	def stop(self):
 		self.__isRunning = False
-		for _ in algorithms.itr_available(self.__workQueue):
-			pass # eat up queue to cut down dumb work
+		algorithms.drain(self.__workQueue) # eat up queue to cut down dumb work
 		self.__workQueue.put(_QUEUE_EMPTY)
 
 	def clear_tasks(self):
-		for _ in algorithms.itr_available(self.__workQueue):
-			pass # eat up queue to cut down dumb work
+		algorithms.drain(self.__workQueue) # eat up queue to cut down dumb work
 
 	def add_task(self, func, args, kwds, on_success, on_error):
 		task = func, args, kwds, on_success, on_error